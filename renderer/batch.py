@@ -0,0 +1,117 @@
+"""
+Renders every system in a directory, in several formats, across all CPU
+cores - skipping any output whose source hasn't changed since it was last
+rendered.
+"""
+
+import hashlib
+import json
+import multiprocessing
+import os
+import argparse
+from main import Map, RENDERER_VERSION
+
+
+FORMATS = ["pdf", "svg", "png"]
+MANIFEST_NAME = ".render-manifest.json"
+
+
+def find_systems(systems_dir):
+    """
+    Returns the paths of all system files in the directory, which are the
+    .txt files inside each system's own subdirectory (e.g. london/london.txt).
+    """
+    sources = []
+    for name in sorted(os.listdir(systems_dir)):
+        system_dir = os.path.join(systems_dir, name)
+        if os.path.isdir(system_dir):
+            for filename in sorted(os.listdir(system_dir)):
+                if filename.endswith(".txt"):
+                    sources.append(os.path.join(system_dir, filename))
+    return sources
+
+
+def source_digest(filename):
+    "Returns the hash a source file's outputs are stamped with."
+    digest = hashlib.sha1(RENDERER_VERSION)
+    with open(filename, "rb") as fh:
+        digest.update(fh.read())
+    return digest.hexdigest()
+
+
+def render_worker(job):
+    "Renders one source file to each of the given outputs."
+    source, outputs = job
+    m = Map()
+    m.load(source)
+    for output in outputs:
+        m.render(output)
+    return job
+
+
+def render_all(systems_dir, formats=FORMATS, processes=None, force=False):
+    """
+    Renders every system in systems_dir to each format, next to its source.
+    A manifest of what each output was rendered from is kept in
+    systems_dir, and outputs that are still current are skipped.
+    Returns (rendered, skipped) output counts.
+    """
+    manifest_path = os.path.join(systems_dir, MANIFEST_NAME)
+    try:
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+    except (IOError, ValueError):
+        manifest = {}
+    # Work out what's out of date; one job per source, so each map is
+    # only loaded once however many formats it needs.
+    jobs = []
+    digests = {}
+    skipped = 0
+    for source in find_systems(systems_dir):
+        digest = source_digest(source)
+        outputs = []
+        for format in formats:
+            output = os.path.splitext(source)[0] + "." + format
+            key = os.path.relpath(output, systems_dir)
+            digests[key] = digest
+            if force or manifest.get(key) != digest or not os.path.exists(output):
+                outputs.append(output)
+            else:
+                skipped += 1
+        if outputs:
+            jobs.append((source, outputs))
+    # Render them
+    rendered = 0
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            for source, outputs in pool.imap_unordered(render_worker, jobs):
+                # Record each as it finishes, so a failure keeps the rest
+                for output in outputs:
+                    key = os.path.relpath(output, systems_dir)
+                    manifest[key] = digests[key]
+                rendered += len(outputs)
+        finally:
+            pool.close()
+            pool.join()
+            with open(manifest_path + ".new", "w") as fh:
+                json.dump(manifest, fh, indent=1, sort_keys=True)
+            os.rename(manifest_path + ".new", manifest_path)
+    return rendered, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render every Twin Tubes system in a directory")
+    parser.add_argument('systems_dir', help='The directory containing one subdirectory per system')
+    parser.add_argument('-f', '--format', action='append', choices=FORMATS, help='A format to render (may be given more than once; default all)')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='How many processes to render with')
+    parser.add_argument('--force', action='store_true', help='Render everything, changed or not')
+    args = parser.parse_args()
+
+    rendered, skipped = render_all(
+        args.systems_dir,
+        formats = args.format or FORMATS,
+        processes = args.processes,
+        force = args.force,
+    )
+    print "Rendered %i outputs, %i unchanged" % (rendered, skipped)
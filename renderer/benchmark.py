@@ -0,0 +1,300 @@
+"""
+Benchmarks for parsing, routing, laying out and rendering maps, plus
+micro-benchmarks for the geometry primitives (Vector and Direction).
+
+Each stage is timed separately, in its own process so its peak memory can
+be measured, and can be compared against a saved baseline to catch
+regressions. Run as:
+
+    python benchmark.py --save-baseline     # on the code you trust
+    python benchmark.py --compare           # on your changes
+
+With no system files given, it uses London and San Francisco.
+"""
+
+import gc
+import json
+import marshal
+import os
+import resource
+import sys
+import tempfile
+import time
+import argparse
+import cairo
+import vector
+from draw import Direction, Segment
+from geometry import measuring_context
+from main import Map
+from vector import Vector
+
+
+SYSTEMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "systems")
+DEFAULT_SYSTEMS = [
+    os.path.join(SYSTEMS_DIR, "london", "london.txt"),
+    os.path.join(SYSTEMS_DIR, "san-francisco", "san-francisco.txt"),
+]
+DEFAULT_BASELINE = "benchmark-baseline.json"
+METRICS = ["seconds", "peak_kb", "vectors", "retained"]
+
+
+def best_time(func, repeat=5, setup=None):
+    """
+    Runs func repeat times, returning the fastest time in seconds. If setup
+    is given, its result is passed to func, and it isn't timed.
+    """
+    best = None
+    for i in range(repeat):
+        arg = setup() if setup else None
+        gc.collect()
+        start = time.time()
+        if setup:
+            func(arg)
+        else:
+            func()
+        taken = time.time() - start
+        if best is None or taken < best:
+            best = taken
+    return best
+
+
+class AllocationCounter(object):
+    """
+    Counts Vectors and Directions created while it's active, by wrapping
+    their constructors.
+    """
+
+    def __enter__(self):
+        self.vectors = 0
+        self.directions = len(Direction.instances)
+        self.orig_new = Vector.__new__
+        self.orig_make = vector._make
+        counter = self
+
+        def counting_new(cls, *args):
+            counter.vectors += 1
+            return counter.orig_new(cls, *args)
+
+        def counting_make(x, y):
+            counter.vectors += 1
+            return counter.orig_make(x, y)
+
+        Vector.__new__ = staticmethod(counting_new)
+        vector._make = counting_make
+        return self
+
+    def __exit__(self, *exc_info):
+        Vector.__new__ = staticmethod(self.orig_new)
+        vector._make = self.orig_make
+        self.directions = len(Direction.instances) - self.directions
+
+
+def route_all(m):
+    "Solves every track and platform route in the map from scratch."
+    Segment.route_cache.clear()
+    for index in range(len(m.outbounds)):
+        m.outbound_segment(index).route().outline
+    for station in m.stations.values():
+        for platform in station.platforms.values():
+            Segment(
+                platform.start_point,
+                platform.direction,
+                platform.end_point,
+                platform.direction,
+            ).route().outline
+
+
+def direction_chains():
+    "The kind of chained direction lookups the router and labels do."
+    for i in range(10000):
+        for direction in Direction.instances.values():
+            direction.left.left.right.right.vector
+            direction.opposite.vector
+            direction.normalized.right.right.vector
+            direction.delta(direction.left)
+
+
+def vector_arithmetic():
+    "The kind of vector sums the router and labels do."
+    a = Vector(1.5, 2.5)
+    b = Vector(-3, 4)
+    seen = set()
+    for i in range(100000):
+        c = (a + b) * 0.5 - a
+        seen.add(c)
+        abs(c)
+
+
+def loaded(filename):
+    "Returns a freshly loaded map, with nothing routed or laid out."
+    Segment.route_cache.clear()
+    m = Map()
+    m.load(filename)
+    return m
+
+
+def laid_out(filename):
+    "Returns a freshly loaded map that's been laid out, ready to draw."
+    m = loaded(filename)
+    m.layout(measuring_context())
+    return m
+
+
+def render_pdf(m):
+    with tempfile.TemporaryFile() as fh:
+        surface = cairo.PDFSurface(fh, *m.size())
+        m.render_to(surface)
+        surface.finish()
+
+
+def render_image(m):
+    width, height = m.size()
+    m.render_to(cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height)))
+
+
+def render_recording(m):
+    m.render_to(cairo.RecordingSurface(cairo.CONTENT_COLOR_ALPHA, None))
+
+
+def stages(filename):
+    """
+    Returns (name, func, setup) for each stage of making the given map; func
+    gets the result of setup, which isn't timed.
+    """
+    name = os.path.splitext(os.path.basename(filename))[0]
+    result = [
+        ("parse %s" % name, lambda _: Map().load(filename, use_cache=False), lambda: None),
+        ("load cached %s" % name, lambda _: Map().load(filename), lambda: Map().load(filename)),
+        ("route %s" % name, route_all, lambda: loaded(filename)),
+        ("layout %s" % name, lambda m: m.layout(measuring_context()), lambda: loaded(filename)),
+        ("render pdf %s" % name, render_pdf, lambda: laid_out(filename)),
+        ("render image %s" % name, render_image, lambda: laid_out(filename)),
+    ]
+    # Recording surfaces need cairo 1.10 and a recent pycairo
+    if hasattr(cairo, "RecordingSurface"):
+        result.append(("render recording %s" % name, render_recording, lambda: laid_out(filename)))
+    return result
+
+
+def measure(func, setup, repeat):
+    """
+    Times func and counts what it allocates, in a child process so that
+    the peak memory is just that of this stage. Returns a dict of METRICS.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # In the child; anything going wrong is reported as a None result
+        try:
+            os.close(read_fd)
+            arg = setup()
+            gc.collect()
+            before = len(gc.get_objects())
+            with AllocationCounter() as counter:
+                func(arg)
+            gc.collect()
+            result = {
+                "vectors": counter.vectors,
+                "retained": len(gc.get_objects()) - before,
+            }
+            del arg
+            result["seconds"] = best_time(func, repeat, setup)
+            result["peak_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if sys.platform == "darwin":
+                result["peak_kb"] //= 1024
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+            result = None
+        os.write(write_fd, marshal.dumps(result))
+        os._exit(0)
+    os.close(write_fd)
+    data = []
+    while True:
+        chunk = os.read(read_fd, 4096)
+        if not chunk:
+            break
+        data.append(chunk)
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    return marshal.loads("".join(data))
+
+
+def run(filenames, repeat):
+    "Runs every benchmark, printing and returning {name: {metric: value}}."
+    results = {}
+    print "%-40s %10s %10s %10s %10s" % ("benchmark", "seconds", "peak kb", "vectors", "retained")
+    all_stages = [
+        ("direction chains", lambda _: direction_chains(), lambda: None),
+        ("vector arithmetic", lambda _: vector_arithmetic(), lambda: None),
+    ]
+    for filename in filenames:
+        all_stages.extend(stages(filename))
+    for name, func, setup in all_stages:
+        result = measure(func, setup, repeat)
+        if result is None:
+            print "%-40s failed" % name
+            continue
+        results[name] = result
+        print "%-40s %10.4f %10i %10i %10i" % (
+            name,
+            result["seconds"],
+            result["peak_kb"],
+            result["vectors"],
+            result["retained"],
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints how each result changed from the baseline, and returns the
+    (name, metric) pairs that got worse by more than tolerance (a fraction).
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print "%-40s (not in baseline)" % name
+            continue
+        for metric in METRICS:
+            new = results[name][metric]
+            old = baseline[name][metric]
+            # Don't flag tiny absolute changes to tiny numbers
+            limit = old * (1 + tolerance) + (0.001 if metric == "seconds" else 1)
+            if new > limit:
+                regressions.append((name, metric))
+                flag = "REGRESSION"
+            else:
+                flag = ""
+            if old:
+                change = "%+.1f%%" % ((new - old) * 100.0 / old)
+            else:
+                change = "%+g" % (new - old)
+            print "%-40s %-10s %12g -> %-12g %8s %s" % (name, metric, old, new, change, flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark parsing, layout and rendering of Twin Tubes maps")
+    parser.add_argument('in_files', nargs='*', help='System files to benchmark (default London and San Francisco)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='How many runs to take the best time of')
+    parser.add_argument('-b', '--baseline', default=DEFAULT_BASELINE, help='The baseline file to save to or compare with')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--compare', action='store_true', help='Compare the results with the baseline, failing on regressions')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1, help='How much worse (as a fraction) counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.in_files or DEFAULT_SYSTEMS, args.repeat)
+    if args.save_baseline:
+        with open(args.baseline, "w") as fh:
+            json.dump(results, fh, indent=1, sort_keys=True)
+        print "Saved baseline to %s" % args.baseline
+    if args.compare:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        print
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print "%i regressions over %.0f%%" % (len(regressions), args.tolerance * 100)
+            sys.exit(1)
+        print "No regressions over %.0f%%" % (args.tolerance * 100)
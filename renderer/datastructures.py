@@ -1,123 +1,171 @@
-import copy
-from types import GeneratorType
-
-
-class SortedDict(dict):
+class OrderedMap(dict):
     """
-    A dictionary that keeps its keys in the order in which they're inserted.
-    Shamelessly ripped from Django
+    A dictionary that keeps its keys in the order in which they're inserted,
+    unless moved with insert() or move_to_end().
+
+    The order is kept as a doubly-linked list, so adding and removing keys
+    and moving them to either end are all O(1). keys() and values() are
+    tuples that are kept until the next change (each of which bumps
+    version), so they can be iterated every frame without copying anything.
+
+    Unlike the lists dict (and the old SortedDict) returns, those tuples
+    can't be changed in place, and the same one is handed to every caller;
+    anything that wants to change the result has to list() it first.
+    items() is still a new list each time.
     """
-    def __new__(cls, *args, **kwargs):
-        instance = super(SortedDict, cls).__new__(cls, *args, **kwargs)
-        instance.keyOrder = []
-        return instance
-
-    def __init__(self, data=None):
-        if data is None:
-            data = {}
-        elif isinstance(data, GeneratorType):
-            # Unfortunately we need to be able to read a generator twice.  Once
-            # to get the data into self with our super().__init__ call and a
-            # second time to setup keyOrder correctly
-            data = list(data)
-        super(SortedDict, self).__init__(data)
-        if isinstance(data, dict):
-            self.keyOrder = data.keys()
-        else:
-            self.keyOrder = []
-            seen = set()
-            for key, value in data:
-                if key not in seen:
-                    self.keyOrder.append(key)
-                    seen.add(key)
 
-    def __deepcopy__(self, memo):
-        return self.__class__([(key, copy.deepcopy(value, memo))
-                               for key, value in self.iteritems()])
+    def __init__(self, data=()):
+        super(OrderedMap, self).__init__()
+        # [previous key, next key] by key, with the ends linked to END
+        self.links = {END: [END, END]}
+        self.version = 0
+        self.cached_version = None
+        self.cached_keys = ()
+        self.cached_values = ()
+        if isinstance(data, dict):
+            data = data.items()
+        for key, value in data:
+            self[key] = value
+
+    def __reduce__(self):
+        return (self.__class__, (self.items(), ))
+
+    def link(self, key, successor):
+        "Puts a key into the order just before successor."
+        links = self.links
+        predecessor = links[successor][0]
+        links[key] = [predecessor, successor]
+        links[predecessor][1] = key
+        links[successor][0] = key
+
+    def unlink(self, key):
+        "Takes a key out of the order."
+        links = self.links
+        predecessor, successor = links.pop(key)
+        links[predecessor][1] = successor
+        links[successor][0] = predecessor
 
     def __setitem__(self, key, value):
         if key not in self:
-            self.keyOrder.append(key)
-        super(SortedDict, self).__setitem__(key, value)
+            self.link(key, END)
+        super(OrderedMap, self).__setitem__(key, value)
+        self.version += 1
 
     def __delitem__(self, key):
-        super(SortedDict, self).__delitem__(key)
-        self.keyOrder.remove(key)
+        super(OrderedMap, self).__delitem__(key)
+        self.unlink(key)
+        self.version += 1
 
     def __iter__(self):
-        return iter(self.keyOrder)
+        return iter(self.keys())
 
-    def pop(self, k, *args):
-        result = super(SortedDict, self).pop(k, *args)
-        try:
-            self.keyOrder.remove(k)
-        except ValueError:
-            # Key wasn't in the dictionary in the first place. No problem.
-            pass
-        return result
+    def pop(self, key, *args):
+        if key in self:
+            self.unlink(key)
+            self.version += 1
+        return super(OrderedMap, self).pop(key, *args)
 
     def popitem(self):
-        result = super(SortedDict, self).popitem()
-        self.keyOrder.remove(result[0])
-        return result
+        "Removes and returns the last (key, value) pair."
+        if not self:
+            raise KeyError("popitem(): dictionary is empty")
+        key = self.links[END][0]
+        return key, self.pop(key)
 
-    def items(self):
-        return zip(self.keyOrder, self.values())
+    def update(self, dict_):
+        for key, value in dict_.iteritems():
+            self[key] = value
 
-    def iteritems(self):
-        for key in self.keyOrder:
-            yield key, self[key]
+    def setdefault(self, key, default):
+        if key not in self:
+            self[key] = default
+        return self[key]
 
-    def keys(self):
-        return self.keyOrder[:]
+    def clear(self):
+        super(OrderedMap, self).clear()
+        self.links = {END: [END, END]}
+        self.version += 1
+
+    def refresh(self):
+        "Brings the cached keys and values up to date."
+        keys = []
+        links = self.links
+        key = links[END][1]
+        while key is not END:
+            keys.append(key)
+            key = links[key][1]
+        self.cached_keys = tuple(keys)
+        self.cached_values = tuple(map(self.__getitem__, keys))
+        self.cached_version = self.version
 
-    def iterkeys(self):
-        return iter(self.keyOrder)
+    def keys(self):
+        if self.cached_version != self.version:
+            self.refresh()
+        return self.cached_keys
 
     def values(self):
-        return map(self.__getitem__, self.keyOrder)
+        if self.cached_version != self.version:
+            self.refresh()
+        return self.cached_values
 
-    def itervalues(self):
-        for key in self.keyOrder:
-            yield self[key]
+    def items(self):
+        return zip(self.keys(), self.values())
 
-    def update(self, dict_):
-        for k, v in dict_.iteritems():
-            self[k] = v
+    def iterkeys(self):
+        return iter(self.keys())
 
-    def setdefault(self, key, default):
-        if key not in self:
-            self.keyOrder.append(key)
-        return super(SortedDict, self).setdefault(key, default)
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
 
     def value_for_index(self, index):
-        """Returns the value of the item at the given zero-based index."""
-        return self[self.keyOrder[index]]
+        "Returns the value of the item at the given zero-based index."
+        return self.values()[index]
+
+    def move_to_end(self, key, last=True):
+        "Moves an existing key to the end of the order, or the start if not last."
+        self.unlink(key)
+        self.link(key, END if last else self.links[END][1])
+        self.version += 1
 
     def insert(self, index, key, value):
-        """Inserts the key, value pair before the item with the given index."""
-        if key in self.keyOrder:
-            n = self.keyOrder.index(key)
-            del self.keyOrder[n]
-            if n < index:
+        """
+        Inserts the key, value pair before the item with the given index.
+        This is O(1) at either end, and has to walk the order otherwise.
+        """
+        if key in self:
+            # Taking it out from before index moves everything after down one
+            if 0 < index < len(self) and self.keys().index(key) < index:
                 index -= 1
-        self.keyOrder.insert(index, key)
-        super(SortedDict, self).__setitem__(key, value)
+            self.unlink(key)
+            super(OrderedMap, self).__delitem__(key)
+        length = len(self)
+        if index < 0:
+            index = max(length + index, 0)
+        if index >= length:
+            successor = END
+        elif index <= length // 2:
+            successor = self.links[END][1]
+            for i in range(index):
+                successor = self.links[successor][1]
+        else:
+            successor = END
+            for i in range(length - index):
+                successor = self.links[successor][0]
+        self.link(key, successor)
+        super(OrderedMap, self).__setitem__(key, value)
+        self.version += 1
 
     def copy(self):
-        """Returns a copy of this object."""
-        # This way of initializing the copy means it works for subclasses, too.
-        obj = self.__class__(self)
-        obj.keyOrder = self.keyOrder[:]
-        return obj
+        "Returns a copy of this object."
+        return self.__class__(self.items())
 
     def __repr__(self):
-        """
-        Replaces the normal dict.__repr__ with a version that returns the keys
-        in their sorted order.
-        """
+        "Lists the items in order, rather than in dict order."
         return '{%s}' % ', '.join(['%r: %r' % (k, v) for k, v in self.items()])
 
-    def clear(self):
-        super(SortedDict, self).clear()
-        self.keyOrder = []
+
+# Marks both ends of an OrderedMap's order
+END = object()
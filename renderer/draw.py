@@ -2,12 +2,18 @@
 Drawing functions.
 """
 
-import cairo
 import math
+import threading
+from geometry import Path, Stroke, WHITE, point_bounds
 from vector import Vector
 
 
 class Direction(object):
+    """
+    One of the eight compass directions a line can run in. There's only
+    ever one instance of each, with its unit vector, angle and neighbours
+    worked out up front, so the routing code can chain them freely.
+    """
 
     VECS = {
         0: Vector(0, -1),
@@ -20,47 +26,59 @@ class Direction(object):
         7: Vector(-1, -1),
     }
 
-    def __init__(self, direction):
-        self.direction = direction
-
-    @property
-    def vector(self):
-        return self.VECS[self.direction].normalize()
-
-    @property
-    def left(self):
-        return Direction((self.direction - 1) % 8)
+    instances = {}
 
-    @property
-    def angle(self):
-        return (self.direction / 4.0) * math.pi
+    def __new__(cls, direction):
+        try:
+            return cls.instances[direction]
+        except KeyError:
+            raise ValueError("There is no direction %r" % (direction, ))
 
-    @property
-    def right(self):
-        return Direction((self.direction + 1) % 8)
+    def __reduce__(self):
+        return (Direction, (self.direction, ))
 
-    @property
-    def normalized(self):
-        return Direction(self.direction % 4)
+    def __repr__(self):
+        return "<Direction %s>" % self.direction
 
     def __eq__(self, other):
-        return self.direction == other.direction
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
 
     def __hash__(self):
-        return hash(self.direction)
+        return self.direction
 
     def delta(self, other):
-        if other.direction == self.direction:
-            return 0
-        delta = other.direction - self.direction
-        if delta > 4:
-            return delta - 8
-        elif delta < -4:
-            return delta + 8
-        else:
-            return delta
+        return self.deltas[other.direction]
 
+    @classmethod
+    def make_all(cls):
+        "Creates the eight Direction instances and links them together."
+        for direction in range(8):
+            instance = object.__new__(cls)
+            instance.direction = direction
+            instance.vector = cls.VECS[direction].normalize()
+            instance.angle = (direction / 4.0) * math.pi
+            cls.instances[direction] = instance
+        for direction, instance in cls.instances.items():
+            instance.left = cls.instances[(direction - 1) % 8]
+            instance.right = cls.instances[(direction + 1) % 8]
+            instance.opposite = cls.instances[(direction + 4) % 8]
+            instance.normalized = cls.instances[direction % 4]
+            # Shortest turn (-4 to 4, with 4 for a reversal) to each other direction
+            deltas = []
+            for other in range(8):
+                delta = other - direction
+                if delta > 4:
+                    delta -= 8
+                elif delta < -4:
+                    delta += 8
+                deltas.append(delta)
+            instance.deltas = tuple(deltas)
 
+
+Direction.make_all()
 Direction.N = Direction(0)
 Direction.NE = Direction(1)
 Direction.E = Direction(2)
@@ -71,6 +89,135 @@ Direction.W = Direction(6)
 Direction.NW = Direction(7)
 
 
+class Route(object):
+    """
+    A solved route through the grid: the (corner, direction) pairs the line
+    passes through, and the outline Path made by rounding off its corners -
+    plus outlines running parallel to it, for multi-coloured lines.
+    """
+
+    def __init__(self, path, radius, solved=True):
+        self.path = path
+        self.radius = radius
+        # False if the line couldn't get to its end on the grid
+        self.solved = solved
+        # Outlines by sideways offset, worked out as they're needed
+        self.outlines = {}
+
+    @property
+    def outline(self):
+        return self.offset_outline(0)
+
+    def offset_outline(self, offset):
+        """
+        Returns the outline shifted offset to the right of the direction of
+        travel. Each corner is rounded off around the same centre as the
+        outline's, with the radius shrunk or grown by offset, so parallel
+        outlines stay the same distance apart all the way round.
+        """
+        if offset not in self.outlines:
+            path = self.path
+            start = path[0][0]
+            if offset and len(path) > 1:
+                start = start + path[1][1].right.right.vector * offset
+            ops = [("move_to", start.x, start.y)]
+            for (corner, dir), (next_corner, next_dir) in zip(path[1:], path[2:]):
+                # Work out where the center of the arc is
+                out_vector = (dir.vector + next_dir.vector.flip()).normalize().flip()
+                dir_delta = dir.delta(next_dir)
+                center_point = corner + (out_vector * (self.radius / math.cos(dir_delta * math.pi * 0.125)))
+                if dir_delta > 0:
+                    # Turning right, so the right-hand side is the inside
+                    ops.append((
+                        "arc",
+                        center_point.x,
+                        center_point.y,
+                        self.radius - offset,
+                        (next_dir.angle + (math.pi * 0.75)) % (math.pi * 2),
+                        (dir.angle - (math.pi * 0.75)) % (math.pi * 2),
+                    ))
+                else:
+                    ops.append((
+                        "arc_negative",
+                        center_point.x,
+                        center_point.y,
+                        self.radius + offset,
+                        (next_dir.angle + (math.pi * 0.25)) % (math.pi * 2),
+                        (dir.angle - (math.pi * 0.25)) % (math.pi * 2),
+                    ))
+            # The rounded line never leaves the hull of its corners
+            self.outlines[offset] = Path(ops, point_bounds(
+                [corner.tuple() for corner, dir in path],
+                abs(offset),
+            ))
+        return self.outlines[offset]
+
+
+class RouteCache(object):
+    """
+    Remembers solved routes, keyed on everything that affects their shape.
+    Entries are also indexed by their end points, so that when a station
+    moves only the routes touching it need to be thrown away. Maps laid out
+    in different threads can share one.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.by_point = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get(self, key):
+        return self.routes.get(key)
+
+    def add(self, key, route):
+        with self.lock:
+            self.routes[key] = route
+            # Index by start and end point
+            self.by_point.setdefault(key[0], set()).add(key)
+            self.by_point.setdefault(key[2], set()).add(key)
+        return route
+
+    def evict_points(self, points):
+        "Removes every route that starts or ends at one of the given points."
+        with self.lock:
+            for point in points:
+                for key in self.by_point.pop(point, ()):
+                    self.routes.pop(key, None)
+                    # Tidy up the other end's index entry
+                    other = key[2] if key[0] == point else key[0]
+                    keys = self.by_point.get(other)
+                    if keys is not None:
+                        keys.discard(key)
+                        if not keys:
+                            del self.by_point[other]
+
+    def clear(self):
+        with self.lock:
+            self.routes.clear()
+            self.by_point.clear()
+
+
+# The stages Segment.solve() searches through, by how many 45 degree turns
+# a route needs to get from the start direction to the end direction:
+# min_length steps until it's within two, then a double bend, a single bend,
+# and a dogleg with its single bend back. Any of them can finish the route
+# early; none is tried twice, so a route has at most 8 stages (16 if it's
+# replanned once).
+ROUTE_PLANS = {
+    0: ("dogleg", "return"),
+    1: ("single", "dogleg", "return"),
+    2: ("double", "single", "dogleg", "return"),
+    3: ("step", "double", "single", "dogleg", "return"),
+    4: ("step", "step", "double", "single", "dogleg", "return"),
+    5: ("step", "step", "step", "double", "single", "dogleg", "return"),
+    6: ("step", "step", "step", "step", "double", "single", "dogleg", "return"),
+    7: ("step", "step", "step", "step", "step", "double", "single", "dogleg", "return"),
+}
+
+
 class Segment(object):
     """
     Represents a (stylistic Tube) line on the canvas.
@@ -90,6 +237,8 @@ class Segment(object):
     PLATFORM_RIGHT = 2
     PLATFORM_BOTH = 3
 
+    route_cache = RouteCache()
+
     def __init__(self, start_point, start_dir, end_point, end_dir, colors=None, platform=0, subtrack=False, dashed=False, platform_color=(0, 0, 0)):
         self.start_point = start_point
         self.start_dir = start_dir
@@ -101,194 +250,208 @@ class Segment(object):
         self.dashed = dashed
         self.platform_color = platform_color
 
-    def draw(self, ctx):
-        "Draws the actual line on the given Cairo context"
+    def route_key(self):
+        "Returns the key this segment's Route is cached under."
+        return (
+            self.start_point,
+            self.start_dir,
+            self.end_point,
+            self.end_dir,
+            self.min_length,
+            self.radius,
+        )
+
+    def route(self):
+        "Returns the solved Route for this segment, from the cache if possible."
+        key = self.route_key()
+        route = self.route_cache.get(key)
+        if route is None:
+            path, solved = self.solve()
+            route = self.route_cache.add(key, Route(path, self.radius, solved))
+        return route
+
+    def solve(self):
+        """
+        Works out the list of (corner, direction) pairs the line follows,
+        and whether it actually gets to the end on the grid. This is a
+        bounded search rather than a formula: it works through the stages
+        ROUTE_PLANS gives for the direction pair, checking after each
+        whether the end is straight ahead, and replans at most once.
+        """
+        end_point = self.end_point
         point = self.start_point
         dir = self.start_dir
-        path = [(self.start_point, None)]
-        while point != self.end_point:
-            # Work out if the endpoint is to the left, right, or straight on
-            # (done using dot product).
-            toend = self.end_point - point
+        path = [(point, None)]
+        bend, unbend, stages = self.plan(end_point - point, dir)
+        replanned = False
+        while stages:
+            stage = stages.pop(0)
+            toend = end_point - point
             # See if the result is directly ahead.
             if round(toend.projonto(dir.vector), 1) == round(abs(toend), 1):
-                path.append((self.end_point, dir))
-                break
-            # Work out left and right dot projections
+                path.append((end_point, dir))
+                return path, True
+            # The dogleg comes back the other way for its last bend
+            if stage == "return":
+                bend = unbend
+            # If turning towards the end point has taken us past it, so it's
+            # now on the other side, swing back round to meet it - once.
             left_proj = toend.projonto(dir.left.vector)
             right_proj = toend.projonto(dir.right.vector)
-            if left_proj > right_proj:
-                bend = lambda x: x.left
-                proj_value = left_proj
-            else:
-                bend = lambda x: x.right
-                proj_value = right_proj
-            # Does it match a known pattern?
-            # Single bend
-            if self.end_dir == bend(dir) and proj_value > 0:
-                # Work out the intersection point
-                first_vector = dir.vector
-                second_vector = bend(dir).vector
-                p = Vector(second_vector.y, -second_vector.x)
-                h = ((self.end_point - point).dot(p)) / first_vector.dot(p)
-                if h > 0:
-                    intersects = point + (first_vector * h)
-                    # Go there.
-                    path.append((intersects, dir))
-                    path.append((self.end_point, bend(dir)))
+            if (left_proj > right_proj) != (bend(dir) is dir.left):
+                if replanned or stage == "return":
                     break
-                else:
-                    # We can't make that. Go min length then turn
-                    path.append((
-                        (point + dir.vector * self.min_length),
-                        dir,
-                    ))
-                    point = path[-1][0]
-                    dir = bend(dir)
-            # Double bend
-            elif self.end_dir == bend(bend(dir)) and proj_value > 0:
-                # Work out the intersection point
+                replanned = True
+                bend, unbend, stages = self.plan(toend, dir)
+                stage = stages.pop(0)
+            proj_value = max(left_proj, right_proj)
+            if stage == "step":
+                point = self.step(path, point, dir)
+                dir = bend(dir)
+            elif stage == "double":
+                # Go up to where the lines meet but not quite, so we get a
+                # nice corner, and leave the rest to the single bend
                 first_vector = dir.vector
                 second_vector = bend(bend(dir)).vector
-                p = Vector(second_vector.y, -second_vector.x)
-                h = ((self.end_point - point).dot(p)) / first_vector.dot(p)
-                if h > 0:
+                h = self.meeting_distance(toend, first_vector, second_vector)
+                if proj_value > 0 and h > 0:
                     intersects = point + (first_vector * h)
-                    # Go up to it but not quite, so we get a nice corner
                     offset = min(
-                        abs((self.end_point - intersects).projonto(second_vector)),
+                        abs((end_point - intersects).projonto(second_vector)),
                         abs((self.start_point - intersects).projonto(first_vector)),
                     )
                     path.append((intersects - (first_vector * (offset - self.min_length)), dir))
                     point = path[-1][0]
-                    dir = bend(dir)
                 else:
-                    # We can't make that. Go min length then turn
-                    path.append((
-                        (point + dir.vector * self.min_length),
-                        dir,
-                    ))
-                    point = path[-1][0]
-                    dir = bend(dir)
-            # Dogleg
-            elif self.end_dir == dir and proj_value > 0:
-                # Work out the midpoint
-                mid = (self.start_point + self.end_point) / 2.0
-                # Work out the intersection
+                    point = self.step(path, point, dir)
+                dir = bend(dir)
+            elif stage in ("single", "return"):
+                # Turn once, where the two lines meet
                 first_vector = dir.vector
-                second_vector = bend(dir).vector
-                p = Vector(second_vector.y, -second_vector.x)
-                h = ((mid - point).dot(p)) / first_vector.dot(p)
-                intersects = point + (first_vector * h)
-                # Turn at that point
-                path.append((intersects, dir))
-                point = path[-1][0]
+                h = self.meeting_distance(toend, first_vector, bend(dir).vector)
+                if proj_value > 0 and h > 0:
+                    path.append((point + (first_vector * h), dir))
+                    path.append((end_point, bend(dir)))
+                    return path, True
+                if stage == "return":
+                    break
+                point = self.step(path, point, dir)
                 dir = bend(dir)
-            # Too much already?
-            elif len(path) > 10:
-                break
-            # Nope. Go for the min length and turn.
-            else:
-                path.append((
-                    (point + dir.vector * self.min_length),
-                    dir,
-                ))
+            elif stage == "dogleg":
+                # Turn where we cross the line halfway between the two ends
+                if proj_value <= 0:
+                    break
+                mid = (self.start_point + end_point) / 2.0
+                h = self.meeting_distance(mid - point, dir.vector, bend(dir).vector)
+                path.append((point + (dir.vector * h), dir))
                 point = path[-1][0]
                 dir = bend(dir)
+        # There's no way there on the grid
+        path.append((end_point, dir))
+        return path, False
+
+    def plan(self, toend, dir):
+        """
+        Returns which way to turn (and the opposite) to get to the end point
+        toend away, heading in dir, and the stages of the route from there.
+        """
+        if toend.projonto(dir.left.vector) > toend.projonto(dir.right.vector):
+            turns = -dir.delta(self.end_dir) % 8
+            return (lambda x: x.left), (lambda x: x.right), list(ROUTE_PLANS[turns])
+        turns = dir.delta(self.end_dir) % 8
+        return (lambda x: x.right), (lambda x: x.left), list(ROUTE_PLANS[turns])
+
+    def step(self, path, point, dir):
+        "Goes min_length straight on before the next turn, returning where to."
+        path.append((point + dir.vector * self.min_length, dir))
+        return path[-1][0]
+
+    def meeting_distance(self, toend, first_vector, second_vector):
+        """
+        Returns how far along first_vector a line has to go to meet the line
+        along second_vector through the end point, toend away.
+        """
+        p = Vector(second_vector.y, -second_vector.x)
+        return toend.dot(p) / first_vector.dot(p)
+
+    def estimated_bounds(self):
+        """
+        Returns a box the segment is sure to fit in, without routing it.
+        Routes can overshoot their end points by a few min_length steps,
+        or by up to their own length when meeting a diagonal.
+        """
+        margin = (
+            abs(self.end_point - self.start_point) +
+            self.min_length * 11 +
+            self.radius +
+            self.back_width
+        )
+        return point_bounds(
+            [self.start_point.tuple(), self.end_point.tuple()],
+            margin,
+        )
+
+    def layout(self):
+        """
+        Returns the Strokes that draw this segment, bottom one first. Lines
+        with several colours are drawn as parallel bands, side by side in
+        the width a single line takes (so platforms and neighbouring track
+        keep their spacing), with the first colour on the left.
+        """
+        route = self.route()
+        outline = route.outline
+        end = route.path[-1][0]
+        # Overshoot slightly to stop artifacts, if this isn't the white bit
+        overshoot = (end + self.end_dir.vector * 0.5).tuple()
+        end = end.tuple()
+        strokes = []
         if not self.subtrack:
             # Draw the white background to do crossovers nicely
-            self.draw_path(ctx, path, back=True)
+            strokes.append(Stroke(outline, end, None, WHITE, self.back_width, self.dashed))
         # Possibly draw the platform highlights too
-        if self.platform & 1:
-            ctx.save()
-            ctx.translate(*(self.start_dir.left.left.vector * self.platform_distance))
-            if not self.subtrack:
-                self.draw_path(
-                    ctx,
-                    path,
-                    True,
-                    back = True,
-                )
-            self.draw_path(
-                ctx,
-                path,
-                True,
-            )
-            ctx.restore()
-        if self.platform & 2:
-            ctx.save()
-            ctx.translate(*(self.start_dir.right.right.vector * self.platform_distance))
-            if not self.subtrack:
-                self.draw_path(
-                    ctx,
-                    path,
-                    True,
-                    back = True,
-                )
-            self.draw_path(
-                ctx,
-                path,
-                True,
-            )
-            ctx.restore()
-        # Now, draw the main path.
-        self.draw_path(ctx, path)
-
-    def draw_path(self, ctx, path, platform=False, debug=False, back=False):
-        ctx.move_to(*path[0][0])
-        for (corner, dir), (next_corner, next_dir) in zip(path[1:], path[2:]):
-            # Work out where the center of the arc is
-            out_vector = (dir.vector + next_dir.vector.flip()).normalize().flip()
-            dir_delta = dir.delta(next_dir)
-            center_point = corner + (out_vector * (self.radius / math.cos(dir_delta * math.pi * 0.125)))
-            if dir_delta > 0:
-                ctx.arc(
-                    center_point.x,
-                    center_point.y,
-                    self.radius,
-                    (next_dir.angle + (math.pi * 0.75)) % (math.pi * 2),
-                    (dir.angle - (math.pi * 0.75)) % (math.pi * 2),
-                )
+        for side, side_dir in (
+            (self.PLATFORM_LEFT, self.start_dir.left.left),
+            (self.PLATFORM_RIGHT, self.start_dir.right.right),
+        ):
+            if self.platform & side:
+                offset = (side_dir.vector * self.platform_distance).tuple()
+                if not self.subtrack:
+                    strokes.append(Stroke(outline, end, offset, WHITE, self.platform_back_width, self.dashed))
+                strokes.append(Stroke(outline, overshoot, offset, self.platform_color, self.platform_width, self.dashed))
+        # Now, the main path. Each band runs from its own left edge to the
+        # line's right edge, over the one before, so no gaps can show between.
+        band_width = float(self.width) / len(self.colors)
+        last_dir = route.path[-1][1] or self.end_dir
+        for i, color in enumerate(self.colors):
+            if i == 0:
+                strokes.append(Stroke(outline, overshoot, None, color, self.width, self.dashed))
             else:
-                ctx.arc_negative(
-                    center_point.x,
-                    center_point.y,
-                    self.radius,
-                    (next_dir.angle + (math.pi * 0.25)) % (math.pi * 2),
-                    (dir.angle - (math.pi * 0.25)) % (math.pi * 2),
-                )
-        # Overshoot slightly to stop artifacts, if this isn't the white bit
-        if not back:
-            ctx.line_to(*(path[-1][0] + self.end_dir.vector * 0.5))
-        else:
-            ctx.line_to(*path[-1][0])
-        if platform and back:
-            #ctx.set_line_cap(cairo.LINE_CAP_SQUARE)
-            ctx.set_source_rgb(1, 1, 1)
-            ctx.set_line_width(self.platform_back_width)
-        elif platform:
-            ctx.set_source_rgb(*self.platform_color)
-            ctx.set_line_width(self.platform_width)
-        elif back:
-            ctx.set_source_rgb(1, 1, 1)
-            ctx.set_line_width(self.back_width)
-        else:
-            ctx.set_source_rgb(*self.colors[0])
-            ctx.set_line_width(self.width)
-        # Draw
-        if self.dashed:
-            ctx.set_dash([1])
-        else:
-            ctx.set_dash([])
-        ctx.stroke()
-        ctx.set_dash([])
-        ctx.set_line_cap(cairo.LINE_CAP_BUTT)
-        # Possible debug
-        if debug:
-            ctx.move_to(*path[0][0])
-            for (corner, dir), (next_corner, next_dir) in zip(path[1:], path[2:]):
-                ctx.line_to(*corner)
-            ctx.line_to(*(path[-1][0] + self.end_dir.vector * 0.5))
-            ctx.set_source_rgb(1, 0, 1)
-            ctx.set_line_width(0.5)
-            ctx.stroke()
+                offset = i * band_width / 2
+                band_end = (Vector(*overshoot) + last_dir.right.right.vector * offset).tuple()
+                strokes.append(Stroke(
+                    route.offset_outline(offset),
+                    band_end,
+                    None,
+                    color,
+                    self.width - i * band_width,
+                    self.dashed,
+                ))
+        return strokes
+
+    def layout_overview(self):
+        """
+        Returns the Strokes that draw this segment when zoomed well out:
+        just the line itself, with square corners.
+        """
+        corners = [corner.tuple() for corner, dir in self.route().path]
+        ops = [("move_to", ) + corners[0]]
+        for corner in corners[1:-1]:
+            ops.append(("line_to", ) + corner)
+        return [Stroke(
+            Path(ops, point_bounds(corners)),
+            corners[-1],
+            None,
+            self.colors[0],
+            self.width,
+            self.dashed,
+        )]
@@ -0,0 +1,242 @@
+"""
+Generates synthetic system files, for seeing how the renderer copes with
+networks much bigger than the real ones.
+
+Lines wander across a grid, turning 45 degrees at a time, and stations
+where they cross become interchanges. The output uses everything the
+format has: multiplexed lines, waypoints on bends, sidings at the ends of
+lines, stations positioned relative to others, platforms facing against
+the direction of travel (joined with ! tracks), and subtracks. Run as:
+
+    python generate.py -n 10000 -d 0.5 -o big.txt
+"""
+
+import random
+import argparse
+from draw import Direction
+
+
+DIRECTION_NAMES = dict(
+    (getattr(Direction, name), name)
+    for name in ("N", "NE", "E", "SE", "S", "SW", "W", "NW")
+)
+
+
+def grid_step(direction, distance):
+    "Returns the (x, y) grid move of distance steps in a direction."
+    vector = Direction.VECS[direction.direction]
+    return (vector.x * distance, vector.y * distance)
+
+
+SYLLABLES = [
+    "ash", "bar", "bury", "cam", "den", "ford", "gate", "ham", "hill",
+    "ing", "ley", "mar", "mont", "ton", "vale", "wick", "well", "wood",
+]
+
+
+class Generator(object):
+    """
+    Builds up a random network and writes it out as a system file.
+
+    size is roughly how many stations to make; density (0 to 1) sets how
+    close together they are and how many lines share them.
+    """
+
+    # Chances of each feature, per station (or per line for line features)
+    turn_chance = 0.2
+    waypoint_chance = 0.5
+    relative_chance = 0.2
+    reversed_chance = 0.1
+    sidings_chance = 0.5
+    multiplex_chance = 0.2
+
+    def __init__(self, size, density=0.5, seed=None):
+        self.size = size
+        self.density = min(max(density, 0.0), 1.0)
+        self.random = random.Random(seed)
+        # Grid spacing in file units; denser maps pack stations closer
+        self.spacing = 8 - int(round(4 * self.density))
+        self.line_length = 10 + int(20 * self.density)
+        # Generated things, in the order they get written
+        self.lines = []
+        self.stations = []
+        self.tracks = []
+        # Stations by grid position
+        self.grid = {}
+        self.codes = 0
+
+    def new_code(self, prefix):
+        "Returns a new unique station code."
+        self.codes += 1
+        digits = []
+        number = self.codes
+        while number:
+            number, digit = divmod(number, 26)
+            digits.append(chr(ord("A") + digit))
+        return prefix + "".join(reversed(digits))
+
+    def new_name(self):
+        return " ".join(
+            "".join(self.random.choice(SYLLABLES) for i in range(self.random.randint(2, 3))).title()
+            for j in range(self.random.randint(1, 2))
+        )
+
+    def new_color(self):
+        return "%02x%02x%02x" % tuple(self.random.randint(0, 220) for i in range(3))
+
+    def add_station(self, type, name, position, relative_to=None, code=None):
+        """
+        Adds a station stanza at the (x, y) file position, returning its
+        info dict. Positions relative to another station are written as
+        such, but everything's tracked in absolute terms.
+        """
+        station = {
+            "code": code or self.new_code("S" if type == "station" else "W"),
+            "type": type,
+            "name": name,
+            "position": position,
+            "relative_to": relative_to,
+            "platforms": [],
+        }
+        self.stations.append(station)
+        return station
+
+    def add_platform(self, station, direction, line, side="B"):
+        "Adds a platform, returning its number."
+        number = str(len(station["platforms"]) + 1)
+        station["platforms"].append((number, direction, line, side))
+        return number
+
+    def stop(self, station, direction, line, reversed):
+        """
+        Gives a line a platform at a station, returning (station, platform,
+        reversed) - reversed platforms face against the direction of travel.
+        """
+        if station["type"] == "waypoint":
+            side = None
+        else:
+            side = self.random.choice(["L", "R", "B", "N"])
+        facing = direction.opposite if reversed else direction
+        return (station, self.add_platform(station, facing, line, side), reversed)
+
+    def add_track(self, type, start, end, line):
+        "Joins two stops made by stop()."
+        self.tracks.append("%s %s-%s%s %s-%s%s %s" % (
+            type,
+            start[0]["code"], start[1], "!" if start[2] else "",
+            end[0]["code"], end[1], "!" if end[2] else "",
+            line,
+        ))
+
+    def station_at(self, position, previous):
+        "Returns the station at a grid position, making one if needs be."
+        if position in self.grid:
+            return self.grid[position]
+        relative_to = None
+        if (
+            previous is not None and
+            previous["relative_to"] is None and
+            self.random.random() < self.relative_chance
+        ):
+            relative_to = previous
+        station = self.grid[position] = self.add_station("station", self.new_name(), position, relative_to)
+        return station
+
+    def add_line(self):
+        "Adds a line wandering across the grid from a random start."
+        code = "L%i" % (len(self.lines) + 1)
+        colors = [self.new_color()]
+        if self.random.random() < self.multiplex_chance:
+            colors.append(self.new_color())
+        self.lines.append((code, colors))
+        # Start somewhere within the area the map should cover
+        extent = int((self.size * (1.5 - self.density)) ** 0.5) + 1
+        position = (
+            self.random.randint(0, extent) * self.spacing,
+            self.random.randint(0, extent) * self.spacing,
+        )
+        direction = Direction(self.random.randint(0, 7))
+        station = self.station_at(position, None)
+        last = self.stop(station, direction, code, self.random.random() < self.reversed_chance)
+        first = last
+        for i in range(self.line_length):
+            if len(self.stations) >= self.size:
+                break
+            # Maybe bend, by way of a waypoint half way along
+            turned = False
+            if self.random.random() < self.turn_chance:
+                direction = self.random.choice([direction.left, direction.right])
+                turned = True
+            dx, dy = grid_step(direction, self.random.randint(1, 2) * self.spacing)
+            position = (position[0] + dx, position[1] + dy)
+            if turned and self.random.random() < self.waypoint_chance:
+                waypoint = self.add_station(
+                    "waypoint",
+                    "",
+                    (position[0] - dx / 2.0, position[1] - dy / 2.0),
+                )
+                stop = self.stop(waypoint, direction, code, False)
+                self.add_track("track", last, stop, code)
+                last = stop
+            station = self.station_at(position, last[0])
+            stop = self.stop(station, direction, code, self.random.random() < self.reversed_chance)
+            self.add_track("track", last, stop, code)
+            last = stop
+        # Sidings off the end of the line, joined by subtrack
+        if last is not first and self.random.random() < self.sidings_chance:
+            dx, dy = grid_step(direction, 3)
+            station = last[0]
+            sidings = self.add_station(
+                "sidings",
+                "",
+                (station["position"][0] + dx, station["position"][1] + dy),
+                station,
+                code = station["code"] + "si%i" % len(self.lines),
+            )
+            stop = self.stop(sidings, direction, code, False)
+            self.add_track("subtrack", last, stop, code)
+
+    def generate(self):
+        "Adds lines until there are enough stations."
+        while len(self.stations) < self.size:
+            self.add_line()
+
+    def write(self, fh):
+        "Writes the network out in the system file format."
+        fh.write("# Generated by generate.py: %i stations, %i lines\n\n" % (len(self.stations), len(self.lines)))
+        fh.write("line error ff00ff\n")
+        fh.write("line none ff00ff\n")
+        for code, colors in self.lines:
+            fh.write("line %s %s\n" % (code, ",".join(colors)))
+        fh.write("\n")
+        for station in self.stations:
+            x, y = station["position"]
+            if station["relative_to"] is not None:
+                rx, ry = station["relative_to"]["position"]
+                coords = "%s,%.1f,%.1f" % (station["relative_to"]["code"], x - rx, y - ry)
+            else:
+                coords = "%.1f,%.1f" % (x, y)
+            fh.write("%s %s %s %s\n" % (station["type"], station["code"], station["name"], coords))
+            for number, direction, line, side in station["platforms"]:
+                if side is None:
+                    fh.write("platform %s %s\n" % (number, DIRECTION_NAMES[direction]))
+                else:
+                    fh.write("platform %s %s %s %s\n" % (number, DIRECTION_NAMES[direction], line, side))
+            fh.write("\n")
+        for track in self.tracks:
+            fh.write(track + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Twin Tubes system file")
+    parser.add_argument('-n', '--stations', type=int, default=1000, help='Roughly how many stations to make')
+    parser.add_argument('-d', '--density', type=float, default=0.5, help='From 0 (sparse) to 1 (crowded with interchanges)')
+    parser.add_argument('-s', '--seed', type=int, default=None, help='Random seed, for repeatable output')
+    parser.add_argument('-o', '--out-file', default='generated.txt', help='The file to write')
+    args = parser.parse_args()
+
+    generator = Generator(args.stations, args.density, args.seed)
+    generator.generate()
+    with open(args.out_file, "w") as fh:
+        generator.write(fh)
+    print "Wrote %i stations on %i lines to %s" % (len(generator.stations), len(generator.lines), args.out_file)
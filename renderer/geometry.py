@@ -0,0 +1,339 @@
+"""
+The laid-out geometry of a map.
+
+Map.layout() does all the position, routing and label calculations and
+hands back one of these models; renderers then just walk it and issue cairo
+calls, without ever going near the routing code.
+"""
+
+import hashlib
+from collections import namedtuple
+
+import cairo
+
+
+WHITE = (1, 1, 1)
+
+
+def union_bounds(a, b):
+    "Returns the smallest (x1, y1, x2, y2) box covering both boxes."
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def point_bounds(points, padding=0):
+    "Returns the (x1, y1, x2, y2) box around some (x, y) points."
+    xs = [point[0] for point in points]
+    ys = [point[1] for point in points]
+    return (
+        min(xs) - padding,
+        min(ys) - padding,
+        max(xs) + padding,
+        max(ys) + padding,
+    )
+
+
+def bounds_intersect(a, b):
+    "Returns True if the two boxes overlap."
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def clip_bounds(ctx):
+    """
+    Returns the (x1, y1, x2, y2) box around the context's clip region, with
+    a pixel either way for antialiasing.
+    """
+    x1, y1, x2, y2 = ctx.clip_extents()
+    pad = max([abs(d) for d in ctx.device_to_user_distance(1, 1)])
+    return (x1 - pad, y1 - pad, x2 + pad, y2 + pad)
+
+
+def set_label_font(ctx, face, size):
+    """
+    Sets the context up to measure or draw label text. Hinted metrics
+    would round glyph advances to whole pixels at whatever scale the
+    context happens to be at, so they're turned off; that way text
+    measured once lines up at every zoom level and tile scale.
+    """
+    ctx.select_font_face(
+        face,
+        cairo.FONT_SLANT_NORMAL,
+        cairo.FONT_WEIGHT_NORMAL,
+    )
+    ctx.set_font_size(size)
+    options = cairo.FontOptions()
+    options.set_hint_metrics(cairo.HINT_METRICS_OFF)
+    ctx.set_font_options(options)
+
+
+def measuring_context():
+    "Returns a context for measuring label text, the same in every process."
+    return cairo.Context(cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+
+
+class Path(object):
+    """
+    A line made of straight runs and arcs, stored as a tuple of cairo
+    drawing operations - ("move_to", x, y), ("line_to", x, y),
+    ("arc", cx, cy, r, a1, a2) and ("arc_negative", ...). The final
+    straight run is left to the Stroke, as it varies depending on what's
+    being drawn.
+    """
+
+    def __init__(self, ops, bounds):
+        self.ops = tuple(ops)
+        self.bounds = bounds
+        # (scale, cairo path) for the last scale drawn at
+        self.cached = None
+
+    def __getstate__(self):
+        # Cairo paths can't be pickled; they're rebuilt on demand.
+        return {"ops": self.ops, "bounds": self.bounds, "cached": None}
+
+    def cairo_path(self, ctx):
+        """
+        Returns this path as a cairo path for the context. Arcs are
+        flattened to curves differently depending on scale, so it's built
+        for the context's scale and then replayed with append_path until
+        the scale changes; only the last one is kept, as zooming would
+        otherwise leave one behind for every scale visited. Building one
+        clears the context's current path.
+        """
+        scale = tuple(ctx.get_matrix())[:4]
+        cached = self.cached
+        if cached is not None and cached[0] == scale:
+            return cached[1]
+        ctx.new_path()
+        for op in self.ops:
+            getattr(ctx, op[0])(*op[1:])
+        cairo_path = ctx.copy_path()
+        self.cached = (scale, cairo_path)
+        return cairo_path
+
+    def append_to(self, ctx):
+        "Starts a new path on the context from this one."
+        cairo_path = self.cairo_path(ctx)
+        ctx.new_path()
+        ctx.append_path(cairo_path)
+
+
+class Stroke(namedtuple("Stroke", "path end offset color width dashed")):
+    """
+    A single stroke of a Path: it runs on to the end point, is shifted by
+    offset (or None), and drawn in the given colour and width.
+    """
+
+    @property
+    def style(self):
+        "Everything about how the stroke looks, bar where it goes."
+        return (self.color, self.width, self.dashed)
+
+    @property
+    def bounds(self):
+        x1, y1, x2, y2 = union_bounds(
+            self.path.bounds,
+            point_bounds([self.end]),
+        )
+        dx, dy = self.offset or (0, 0)
+        padding = self.width / 2.0
+        return (
+            x1 + dx - padding,
+            y1 + dy - padding,
+            x2 + dx + padding,
+            y2 + dy + padding,
+        )
+
+    def draw(self, ctx):
+        self.path.append_to(ctx)
+        ctx.line_to(*self.end)
+        ctx.set_source_rgb(*self.color)
+        ctx.set_line_width(self.width)
+        if self.dashed:
+            ctx.set_dash([1])
+        else:
+            ctx.set_dash([])
+        ctx.stroke()
+        ctx.set_dash([])
+        ctx.set_line_cap(cairo.LINE_CAP_BUTT)
+
+
+class Label(namedtuple("Label", "lines glyphs face size color bounds")):
+    """
+    A station label. lines is a tuple of (x, y, text) for each line of
+    text, with (x, y) being where the text starts; glyphs has the same
+    lines already shaped into (index, x, y) glyphs, or None where they
+    couldn't be.
+    """
+
+    def draw(self, ctx):
+        ctx.set_source_rgb(*self.color)
+        set_label_font(ctx, self.face, self.size)
+        for (x, y, text), glyphs in zip(self.lines, self.glyphs):
+            if glyphs is None:
+                ctx.move_to(x, y)
+                ctx.show_text(text)
+            else:
+                ctx.show_glyphs(glyphs)
+
+
+class Element(namedtuple("Element", "key strokes label bounds")):
+    """
+    One thing drawn on the map - a section of track, a platform or a
+    label. key says what it came from, e.g. ("outbound", 12),
+    ("platform", "WAL", "1") or ("label", "WAL").
+    """
+
+    @classmethod
+    def from_strokes(cls, key, strokes):
+        bounds = None
+        for stroke in strokes:
+            bounds = union_bounds(bounds, stroke.bounds)
+        return cls(key, tuple(strokes), None, bounds)
+
+    @classmethod
+    def from_label(cls, key, label):
+        return cls(key, (), label, label.bounds)
+
+    def digest(self):
+        "Returns a hash of everything that affects how this element looks."
+        return hashlib.sha1(repr((
+            self.key,
+            [(stroke.path.ops, ) + tuple(stroke[1:]) for stroke in self.strokes],
+            self.label,
+        ))).hexdigest()
+
+    def draw(self, ctx):
+        offset = None
+        for stroke in self.strokes:
+            # Strokes sharing a shift are drawn inside one translation
+            if stroke.offset != offset:
+                if offset is not None:
+                    ctx.restore()
+                if stroke.offset is not None:
+                    ctx.save()
+                    ctx.translate(*stroke.offset)
+                offset = stroke.offset
+            stroke.draw(ctx)
+        if offset is not None:
+            ctx.restore()
+        if self.label is not None:
+            self.label.draw(ctx)
+
+
+class MapGeometry(namedtuple("MapGeometry", "elements bounds")):
+    """
+    The complete laid-out map: every Element in drawing order, plus the
+    box around all of them.
+    """
+
+    @classmethod
+    def from_elements(cls, elements):
+        bounds = None
+        for element in elements:
+            bounds = union_bounds(bounds, element.bounds)
+        return cls(tuple(elements), bounds)
+
+    def draw(self, ctx):
+        """
+        Draws the map onto the context, skipping anything outside its clip
+        region.
+        """
+        clip = clip_bounds(ctx)
+        draw_batched(ctx, [
+            element for element in self.elements
+            if bounds_intersect(element.bounds, clip)
+        ])
+
+
+def batch_elements(elements, pad, lookback=32):
+    """
+    Sorts the strokes and labels of some elements, in drawing order, into
+    batches that can each be drawn in one go: either a Label, or a list of
+    Strokes with the same style.
+
+    A stroke joins an earlier batch of its style if it doesn't come within
+    pad of anything in that batch or in the ones after it, so drawing the
+    batches gives exactly the same pixels as drawing the elements one by
+    one. Only the last few batches are looked back through, to keep this
+    linear.
+    """
+    # Each batch is [style (None for labels), items, their boxes, union box]
+    batches = []
+    for element in elements:
+        items = list(element.strokes)
+        if element.label is not None:
+            items.append(element.label)
+        for item in items:
+            if isinstance(item, Label):
+                # Glyphs can stray a little outside their extents
+                style = None
+                extra = pad + 1
+            else:
+                # Corners can mitre out a little past the line's edge
+                style = item.style
+                extra = pad + item.width / 2.0
+            x1, y1, x2, y2 = item.bounds
+            bounds = (x1 - extra, y1 - extra, x2 + extra, y2 + extra)
+            target = None
+            if style is not None:
+                for batch in reversed(batches[-lookback:]):
+                    clashes = bounds_intersect(batch[3], bounds) and any(
+                        bounds_intersect(other, bounds) for other in batch[2]
+                    )
+                    if batch[0] == style and not clashes:
+                        target = batch
+                        break
+                    elif clashes:
+                        break
+            if target is None:
+                batches.append([style, [item], [bounds], bounds])
+            else:
+                target[1].append(item)
+                target[2].append(bounds)
+                target[3] = union_bounds(target[3], bounds)
+    return [items[0] if style is None else items for style, items, boxes, union in batches]
+
+
+def draw_batched(ctx, elements):
+    """
+    Draws the elements onto the context with as few strokes and state
+    changes as possible (see batch_elements()).
+    """
+    # Allow a pixel either way for antialiasing
+    pad = max([abs(d) for d in ctx.device_to_user_distance(1, 1)])
+    color = width = dashed = None
+    ctx.set_line_cap(cairo.LINE_CAP_BUTT)
+    for batch in batch_elements(elements, pad):
+        if isinstance(batch, Label):
+            batch.draw(ctx)
+            color = None
+            continue
+        # Building cairo paths clears the current one, so do that first
+        cairo_paths = [stroke.path.cairo_path(ctx) for stroke in batch]
+        ctx.new_path()
+        for stroke, cairo_path in zip(batch, cairo_paths):
+            if stroke.offset is not None:
+                ctx.save()
+                ctx.translate(*stroke.offset)
+            ctx.append_path(cairo_path)
+            ctx.line_to(*stroke.end)
+            if stroke.offset is not None:
+                ctx.restore()
+        stroke = batch[0]
+        if stroke.color != color:
+            color = stroke.color
+            ctx.set_source_rgb(*color)
+        if stroke.width != width:
+            width = stroke.width
+            ctx.set_line_width(width)
+        if stroke.dashed != dashed:
+            dashed = stroke.dashed
+            if dashed:
+                ctx.set_dash([1])
+            else:
+                ctx.set_dash([])
+        ctx.stroke()
+    ctx.set_dash([])
@@ -1,10 +1,16 @@
-from main import Map
+from main import Map, DETAIL_FULL
 from vector import Vector
+from geometry import bounds_intersect, measuring_context
+from profiling import profile_map
 
+import math
 import sys
+import threading
 import pygtk
 pygtk.require('2.0')
+import gobject
 import gtk
+import pango
 import cairo
 
 
@@ -12,11 +18,25 @@ class Gui(object):
 
     def __init__(self, filename):
         self.filename = filename
+        # Held while the map is changed or laid out, as layout happens in
+        # the tile thread. The main loop never waits for it: changes are
+        # queued up, and applied once it's free (see apply_pending()).
+        self.map_lock = threading.Lock()
+        self.pending_moves = []
+        self.reload_wanted = False
+        self.retrying = False
         self.make_window()
         self.map = Map()
         self.map.load(self.filename)
         self.aa = True
         self.markings = True
+        self.heatmap = False
+        # The profile the heatmap shows, once it's been made, and which
+        # profile that should be (so ones superseded can be thrown away)
+        self.heatmap_profiler = None
+        self.profile_number = 0
+        # The thread writing the last save, if it's still going
+        self.saving = None
 
     def make_window(self):
         self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
@@ -52,6 +72,10 @@ class Gui(object):
         self.markings_item.connect("activate", self.markings_toggle)
         menu.append(self.markings_item)
 
+        self.heatmap_item = gtk.MenuItem("Heatmap On")
+        self.heatmap_item.connect("activate", self.heatmap_toggle)
+        menu.append(self.heatmap_item)
+
         save_item = gtk.MenuItem("Reload")
         save_item.connect("activate", self.reload)
         menu.append(save_item)
@@ -86,12 +110,125 @@ class Gui(object):
             self.markings_item.get_child().set_text("Markings On")
         self.renderer.queue_draw()
 
+    def heatmap_toggle(self, *args):
+        """
+        Callback to turn the heatmap on and off. Turning it on lays out and
+        draws a copy of the whole map with a profiler attached, in a
+        separate thread; when that's done, what it found is shown in a
+        window, and the heatmap shows it over the map.
+        """
+        self.heatmap = not self.heatmap
+        self.profile_number += 1
+        if self.heatmap:
+            self.heatmap_item.get_child().set_text("Heatmap Off")
+            thread = threading.Thread(target=self.profile, args=(self.profile_number,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.heatmap_profiler = None
+            self.heatmap_item.get_child().set_text("Heatmap On")
+        self.renderer.queue_draw()
+
+    def profile(self, number):
+        """
+        Profiles a copy of the whole map, so the map itself is only locked
+        while it's copied. Runs in its own thread.
+        """
+        with self.map_lock:
+            tables = self.map.compile()
+        map = Map()
+        map.restore(tables)
+        profiler = profile_map(map)
+        report = profiler.report(map)
+        gobject.idle_add(self.profiled, number, profiler, report)
+
+    def profiled(self, number, profiler, report):
+        "Called in the main loop with a finished profile."
+        if number != self.profile_number:
+            # Superseded by a newer profile, or turned off while being made
+            return False
+        self.heatmap_profiler = profiler
+        self.show_report("Profile of %s" % self.filename, report)
+        self.renderer.queue_draw()
+        return False
+
+    def show_report(self, title, text):
+        "Shows some fixed-width text in a window of its own."
+        view = gtk.TextView()
+        view.set_editable(False)
+        view.modify_font(pango.FontDescription("monospace"))
+        view.get_buffer().set_text(text)
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.add(view)
+        window = gtk.Window(gtk.WINDOW_TOPLEVEL)
+        window.set_title(title)
+        window.set_default_size(600, 500)
+        window.add(scrolled)
+        window.show_all()
+
     def reload(self, *args, **kwds):
-        self.map.load(self.filename)
+        "Callback to load the file again, dropping any unsaved moves."
+        self.pending_moves = []
+        self.reload_wanted = True
+        self.apply_pending()
+
+    def move_stations(self, stations, delta):
+        "Moves the stations along by delta, as soon as the map's free."
+        self.pending_moves.append((stations, delta))
+        self.apply_pending()
+
+    def apply_pending(self):
+        """
+        Makes the queued moves and reload, if the map isn't being laid out
+        (and, for a reload, the last save has finished, so we get what was
+        saved); otherwise tries again shortly.
+        """
+        if not self.pending_moves and not self.reload_wanted:
+            return
+        saving = self.reload_wanted and self.saving is not None and self.saving.is_alive()
+        if saving or not self.map_lock.acquire(False):
+            if not self.retrying:
+                self.retrying = True
+                gobject.timeout_add(20, self.retry_pending)
+            return
+        try:
+            if self.reload_wanted:
+                self.map.load(self.filename)
+                self.reload_wanted = False
+            for stations, delta in self.pending_moves:
+                self.map.translate_stations(stations, delta)
+            self.pending_moves = []
+        finally:
+            self.map_lock.release()
         self.renderer.queue_draw()
 
+    def retry_pending(self):
+        "Called in the main loop a little after apply_pending() couldn't."
+        self.retrying = False
+        self.apply_pending()
+        return False
+
     def save(self, *args, **kwds):
-        self.map.save_offsets(self.filename)
+        "Callback to save moved stations, without holding up the UI."
+        self.saving = self.map.save_offsets(
+            self.filename,
+            background = True,
+            on_error = lambda error: gobject.idle_add(self.save_failed, error),
+        ) or self.saving
+
+    def save_failed(self, error):
+        "Called in the main loop when a background save goes wrong."
+        dialog = gtk.MessageDialog(
+            self.window,
+            gtk.DIALOG_MODAL | gtk.DIALOG_DESTROY_WITH_PARENT,
+            gtk.MESSAGE_ERROR,
+            gtk.BUTTONS_CLOSE,
+            "Couldn't save %s: %s\n\nThe moved stations will be saved next time." % (self.filename, error),
+        )
+        dialog.run()
+        dialog.destroy()
+        return False
 
     def quit(self, *args, **kwds):
         "Exit the app when the main window is closed."
@@ -99,9 +236,255 @@ class Gui(object):
         return False
 
     def main(self):
+        gobject.threads_init()
         gtk.main()
 
 
+class Tile(object):
+    "One rendered tile, and whether the map has changed under it since."
+
+    def __init__(self, surface, stale=False):
+        self.surface = surface
+        self.stale = stale
+        self.used = 0
+
+
+class TileCache(object):
+    """
+    Keeps the map rendered into square image tiles at each zoom level, so
+    redrawing the window just paints them onto it. A background thread lays
+    out the map for each level of detail by calling layout(detail), which
+    returns (map version, MapGeometry), and renders tiles from that geometry
+    (which never changes once made, so the two threads can share it);
+    on_update is called from the main loop as each layout and tile arrives.
+
+    Tiles are keyed on (unit, detail, antialias, x, y), where tile (x, y)
+    covers window pixels x * tile_size to (x + 1) * tile_size when the
+    world origin is at the window's top left.
+    """
+
+    tile_size = 256
+    # About 64MB of tiles
+    max_tiles = 256
+
+    def __init__(self, on_update, layout):
+        self.on_update = on_update
+        self.layout = layout
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.tiles = {}
+        # The current geometry for each level of detail, how many times
+        # it's changed, and the map version it was laid out from
+        self.geometries = {}
+        self.versions = {}
+        self.map_versions = {}
+        # The level of detail to lay out again, if the map's changed
+        self.wanted_layout = None
+        # Tiles to render, most important first
+        self.wanted = []
+        # What was painted last, to fall back on while zooming
+        self.level = None
+        self.fallback_level = None
+        self.painted = 0
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def tile_bounds(self, key):
+        "Returns the (x1, y1, x2, y2) world area a tile covers."
+        unit, detail, antialias, x, y = key
+        size = self.tile_size / unit
+        return (x * size, y * size, (x + 1) * size, (y + 1) * size)
+
+    def check_layout(self, detail, map_version):
+        """
+        Asks for the given level of detail to be laid out again if the map
+        has changed since its geometry was. Only compares version numbers,
+        so it's cheap enough to call on every redraw.
+        """
+        with self.lock:
+            if self.map_versions.get(detail) != map_version:
+                self.wanted_layout = detail
+                self.wake.notify()
+
+    def set_geometry(self, detail, geometry, map_version):
+        """
+        Switches to newly laid-out geometry for a level of detail, marking
+        any of its tiles that changed elements touch as stale (they're still
+        shown until they've been rendered again). Called from the tile
+        thread.
+        """
+        # Only this thread sets geometry, so it can be compared unlocked
+        previous = self.geometries.get(detail)
+        if previous is None:
+            changed = None
+        else:
+            # Unchanged elements are the very same objects between layouts
+            old = set(map(id, previous.elements))
+            new = set(map(id, geometry.elements))
+            changed = [
+                element.bounds for element in previous.elements
+                if id(element) not in new
+            ] + [
+                element.bounds for element in geometry.elements
+                if id(element) not in old
+            ]
+        with self.lock:
+            self.map_versions[detail] = map_version
+            if changed == []:
+                return
+            for key, tile in self.tiles.items():
+                if key[1] != detail:
+                    continue
+                elif changed is None:
+                    tile.stale = True
+                elif not tile.stale:
+                    # Allow a pixel for antialiasing
+                    x1, y1, x2, y2 = self.tile_bounds(key)
+                    pad = 1 / key[0]
+                    tile_bounds = (x1 - pad, y1 - pad, x2 + pad, y2 + pad)
+                    for bounds in changed:
+                        if bounds_intersect(bounds, tile_bounds):
+                            tile.stale = True
+                            break
+            self.geometries[detail] = geometry
+            self.versions[detail] = self.versions.get(detail, 0) + 1
+
+    def paint(self, cr, unit, detail, antialias, x, y, width, height):
+        """
+        Paints whatever tiles there are onto the window, which shows the
+        world from (x, y) at unit pixels per world unit, and asks for the
+        missing and stale ones to be rendered. Never waits for rendering.
+        """
+        size = self.tile_size
+        with self.lock:
+            if (unit, detail) != self.level:
+                self.fallback_level = self.level
+                self.level = (unit, detail)
+            self.painted += 1
+            wanted = []
+            missing = []
+            for key in self.visible_keys(unit, detail, antialias, x, y, width, height):
+                tile = self.tiles.get(key)
+                if tile is None or tile.stale:
+                    wanted.append(key)
+                if tile is None:
+                    missing.append(key)
+            # Anything not rendered yet at this zoom is drawn scaled from the last
+            if missing and self.fallback_level is not None:
+                cr.save()
+                for key in missing:
+                    x1, y1, x2, y2 = self.tile_bounds(key)
+                    cr.rectangle(
+                        round((x1 - x) * unit),
+                        round((y1 - y) * unit),
+                        size,
+                        size,
+                    )
+                cr.clip()
+                fallback_unit, fallback_detail = self.fallback_level
+                self.paint_tiles(cr, fallback_unit, fallback_detail, antialias, x, y, width, height, unit / fallback_unit)
+                cr.restore()
+            self.paint_tiles(cr, unit, detail, antialias, x, y, width, height)
+            self.wanted = wanted
+            self.wake.notify()
+
+    def visible_keys(self, unit, detail, antialias, x, y, width, height):
+        "Returns the keys of the tiles covering the window."
+        size = float(self.tile_size)
+        first_x = int(math.floor(x * unit / size))
+        first_y = int(math.floor(y * unit / size))
+        last_x = int(math.floor((x * unit + width) / size))
+        last_y = int(math.floor((y * unit + height) / size))
+        return [
+            (unit, detail, antialias, tile_x, tile_y)
+            for tile_y in range(first_y, last_y + 1)
+            for tile_x in range(first_x, last_x + 1)
+        ]
+
+    def paint_tiles(self, cr, unit, detail, antialias, x, y, width, height, scale=1):
+        """
+        Paints the tiles there are for the given zoom level, scaled up by
+        scale if they're from a different one.
+        """
+        for key in self.visible_keys(unit, detail, antialias, x, y, width / scale, height / scale):
+            tile = self.tiles.get(key)
+            if tile is not None:
+                tile.used = self.painted
+                x1, y1, x2, y2 = self.tile_bounds(key)
+                cr.save()
+                if scale == 1:
+                    # Whole pixels, so tiles stay sharp and line up
+                    cr.set_source_surface(
+                        tile.surface,
+                        round((x1 - x) * unit),
+                        round((y1 - y) * unit),
+                    )
+                else:
+                    cr.scale(scale, scale)
+                    cr.set_source_surface(
+                        tile.surface,
+                        (x1 - x) * unit,
+                        (y1 - y) * unit,
+                    )
+                cr.paint()
+                cr.restore()
+
+    def run(self):
+        """
+        Lays out the map and renders wanted tiles, forever. Runs in the
+        background thread.
+        """
+        while True:
+            with self.lock:
+                while self.wanted_layout is None and not self.wanted:
+                    self.wake.wait()
+                detail, self.wanted_layout = self.wanted_layout, None
+                if detail is None:
+                    key = self.wanted.pop(0)
+                    geometry = self.geometries.get(key[1])
+                    version = self.versions.get(key[1])
+            if detail is not None:
+                map_version, geometry = self.layout(detail)
+                self.set_geometry(detail, geometry, map_version)
+                gobject.idle_add(self.on_update)
+                continue
+            if geometry is None:
+                # Not laid out yet; it'll be asked for again once it is
+                continue
+            surface = self.render(geometry, key)
+            with self.lock:
+                # If the map changed while we drew, it might be out of date
+                self.tiles[key] = Tile(surface, stale=version != self.versions[key[1]])
+                self.tiles[key].used = self.painted
+                self.evict()
+            gobject.idle_add(self.on_update)
+
+    def render(self, geometry, key):
+        "Renders one tile of the geometry, returning its surface."
+        unit, detail, antialias, x, y = key
+        x1, y1, x2, y2 = self.tile_bounds(key)
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.tile_size, self.tile_size)
+        ctx = cairo.Context(surface)
+        if antialias:
+            ctx.set_antialias(cairo.ANTIALIAS_GRAY)
+        else:
+            ctx.set_antialias(cairo.ANTIALIAS_NONE)
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.paint()
+        ctx.scale(unit, unit)
+        ctx.translate(-x1, -y1)
+        geometry.draw(ctx)
+        return surface
+
+    def evict(self):
+        "Throws away the least recently painted tiles if there are too many."
+        if len(self.tiles) > self.max_tiles:
+            by_use = sorted(self.tiles.items(), key=lambda (key, tile): tile.used)
+            for key, tile in by_use[:len(self.tiles) - self.max_tiles]:
+                del self.tiles[key]
+
+
 class Renderer(gtk.DrawingArea):
 
     # How many pixels before we consider it a drag, not a click
@@ -131,6 +514,25 @@ class Renderer(gtk.DrawingArea):
         self.select_pressed = None
         self.selected = []
 
+        # The map is laid out and drawn into cached tiles in the background
+        self.tiles = TileCache(self.tiles_updated, self.layout)
+        self.measuring_context = measuring_context()
+
+    def tiles_updated(self):
+        "Called in the main loop when a new layout or tile is ready."
+        self.queue_draw()
+        return False
+
+    def layout(self, detail):
+        """
+        Brings the layout for a level of detail up to date (just what's
+        changed), returning (map version, MapGeometry). Runs in the tile
+        thread.
+        """
+        with self.gui.map_lock:
+            map = self.gui.map
+            return map.version, map.layout(self.measuring_context, detail=detail)
+
     # Handle the expose-event by drawing
     def do_expose_event(self, event):
         "Called when something needs drawing."
@@ -154,11 +556,11 @@ class Renderer(gtk.DrawingArea):
         "Callback for the mouse being pressed."
         # If left mouse button pressed...
         if event.button == 1:
-            # Store drag start
+            # Store drag start, and how far the selection's been dragged
             if self.selected:
                 self.pressed = (
                     Vector(event.x, event.y),
-                    [item._offset for item in self.selected],
+                    Vector(0, 0),
                 )
             else:
                 self.pressed = (
@@ -205,10 +607,11 @@ class Renderer(gtk.DrawingArea):
             unit = self.unit_from_window(event.window)
             # Are we dragging a selected thing?
             if self.selected:
-                orig_mouse_pos, orig_poss = self.pressed
-                for item, orig_pos in zip(self.selected, orig_poss):
-                    item._offset = orig_pos + (new_mouse_pos - orig_mouse_pos) / unit
-                    item._offset = (item._offset / 5).floor() * 5
+                orig_mouse_pos, dragged = self.pressed
+                delta = (((new_mouse_pos - orig_mouse_pos) / unit) / 5).floor() * 5
+                if delta != dragged:
+                    self.gui.move_stations(self.selected, delta - dragged)
+                    self.pressed = (orig_mouse_pos, delta)
             # No, just pan.
             else:
                 orig_mouse_pos, orig_window_pos = self.pressed
@@ -270,13 +673,20 @@ class Renderer(gtk.DrawingArea):
         cr.set_source_rgb(1, 1, 1)
         cr.paint()
 
-        # Draw the current map
+        # Paint the map tiles we have; the rest, and the layout if the map
+        # has changed, get done in the background.
+        detail = self.gui.map.detail_for_scale(unit)
+        self.tiles.check_layout(detail, self.gui.map.version)
+        self.tiles.paint(cr, unit, detail, self.gui.aa, self.x, self.y, width, height)
+
+        # Draw the markings over the top, if they'd be readable
         cr.save()
         cr.scale(unit, unit)
         cr.translate(-self.x, -self.y)
-        self.gui.map.draw(cr)
-        if self.gui.markings:
+        if self.gui.markings and detail == DETAIL_FULL:
             self.gui.map.draw_debug(cr, set(self.selected))
+        if self.gui.heatmap_profiler is not None:
+            self.gui.heatmap_profiler.draw_heatmap(cr)
         cr.restore()
 
 
@@ -0,0 +1,268 @@
+"""
+Automatic placement of station labels.
+"""
+
+from draw import Direction, Segment
+from geometry import union_bounds, point_bounds
+from spatial import BoxIndex
+
+
+def overlap_area(a, b):
+    "Returns the area two (x1, y1, x2, y2) boxes have in common."
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width > 0 and height > 0:
+        return width * height
+    return 0
+
+
+def clipped_length(start, end, bounds):
+    """
+    Returns how much of the straight line from start to end lies inside
+    the (x1, y1, x2, y2) box.
+    """
+    x, y = start
+    dx = end[0] - x
+    dy = end[1] - y
+    t0, t1 = 0.0, 1.0
+    for p, q in (
+        (-dx, x - bounds[0]),
+        (dx, bounds[2] - x),
+        (-dy, y - bounds[1]),
+        (dy, bounds[3] - y),
+    ):
+        if p == 0:
+            if q < 0:
+                return 0
+        else:
+            t = q / float(p)
+            if p < 0:
+                t0 = max(t0, t)
+            else:
+                t1 = min(t1, t)
+            if t0 >= t1:
+                return 0
+    return (t1 - t0) * (dx * dx + dy * dy) ** 0.5
+
+
+class LabelPlacer(object):
+    """
+    Picks directions for the labels of stations that don't have one given
+    in the file. Each of the eight directions is tried, and the one whose
+    label covers the least of the other labels, the platforms and the
+    track wins.
+
+    Everything labels have to avoid is kept in spatial indexes, so each
+    station only ever looks at what's near it. After stations move (see
+    forget()) only the labels near what changed are placed again.
+    """
+
+    # In order of preference, for when several are equally good
+    candidates = [
+        Direction.W,
+        Direction.E,
+        Direction.N,
+        Direction.S,
+        Direction.NE,
+        Direction.NW,
+        Direction.SE,
+        Direction.SW,
+    ]
+
+    # How bad it is to cover a unit area of each kind of thing
+    label_weight = 4
+    platform_weight = 2
+    track_weight = 1
+    # Tips otherwise equal choices towards the earlier candidates
+    preference_weight = 0.01
+
+    def __init__(self, map):
+        self.map = map
+        self.started = False
+        # Label boxes by station, and platform boxes by platform
+        self.labels = BoxIndex(50)
+        self.platforms = BoxIndex(50)
+        # Straight pieces of routed track, keyed by (outbound index, n)
+        self.track = BoxIndex(50)
+        self.track_lines = {}
+        self.outbound_pieces = {}
+        # Where each outbound could possibly go, so it's only routed
+        # if a label might land on it
+        self.outbound_reach = BoxIndex()
+        # The area all of an automatic label's candidates cover
+        self.reach = BoxIndex(50)
+        # Things to (re)do on the next place()
+        self.unplaced = set()
+        self.missing_labels = set()
+        self.missing_platforms = set()
+        self.stale_outbounds = set()
+        self.dirty = []
+
+    def start(self, ctx):
+        "Indexes everything with a fixed position, ready for placing."
+        self.started = True
+        for station in self.map.stations.values():
+            for platform in station.platforms.values():
+                self.add_platform(platform, ctx)
+            self.add_label(station, ctx)
+        for index in range(len(self.map.outbounds)):
+            self.add_outbound_reach(index)
+
+    def add_platform(self, platform, ctx):
+        "Indexes a platform, returning its box (or None)."
+        element = self.map.element(platform.key, ctx)
+        if element is not None:
+            self.platforms.insert(platform, element.bounds)
+            return element.bounds
+
+    def add_label(self, station, ctx):
+        """
+        Indexes a station's label if its direction is given, or queues it
+        for placing if not. Returns the box of an indexed label.
+        """
+        if station.name:
+            if station.label_direction:
+                element = self.map.element(station.label_key, ctx)
+                self.labels.insert(station, element.bounds)
+                return element.bounds
+            else:
+                self.unplaced.add(station)
+
+    def add_outbound_reach(self, index):
+        self.outbound_reach.insert(
+            index,
+            self.map.outbound_segment(index).estimated_bounds(),
+        )
+
+    def add_outbound(self, index):
+        "Indexes the pieces of a routed outbound, returning their boxes."
+        padding = Segment.back_width / 2.0
+        with self.map.timing("route solving", ("outbound", index)):
+            route = self.map.outbound_segment(index).route()
+        corners = [corner.tuple() for corner, dir in route.path]
+        items = []
+        boxes = []
+        for n, line in enumerate(zip(corners, corners[1:])):
+            item = (index, n)
+            box = point_bounds(line, padding)
+            self.track.insert(item, box)
+            self.track_lines[item] = line
+            items.append(item)
+            boxes.append(box)
+        self.outbound_pieces[index] = items
+        return boxes
+
+    def remove_outbound(self, index):
+        "Drops an outbound's pieces, returning their boxes."
+        boxes = []
+        for item in self.outbound_pieces.pop(index, ()):
+            boxes.append(self.track.boxes[item])
+            self.track.remove(item)
+            del self.track_lines[item]
+        return boxes
+
+    def forget(self, stations):
+        """
+        Drops everything belonging to the given stations, which are about to
+        move, so it's indexed again (and the labels it was near re-placed)
+        on the next place().
+        """
+        if not self.started:
+            return
+        for station in stations:
+            if station in self.labels:
+                self.dirty.append(self.labels.boxes[station])
+                self.labels.remove(station)
+            if station in self.reach:
+                self.reach.remove(station)
+            self.missing_labels.add(station)
+            for platform in station.platforms.values():
+                if platform in self.platforms:
+                    self.dirty.append(self.platforms.boxes[platform])
+                    self.platforms.remove(platform)
+                self.missing_platforms.add(platform)
+                for index in self.map.platform_outbounds.get(platform, ()):
+                    if index in self.outbound_reach:
+                        self.outbound_reach.remove(index)
+                    self.dirty.extend(self.remove_outbound(index))
+                    self.stale_outbounds.add(index)
+
+    def place(self, ctx):
+        """
+        Gives every automatically-labelled station that needs it a label
+        direction. The first call places them all; after that, only the
+        ones forgotten or near something that was are done again.
+        """
+        with self.map.timing("label placement"):
+            self.place_all(ctx)
+
+    def place_all(self, ctx):
+        if not self.started:
+            self.start(ctx)
+        # Put back whatever moved
+        for platform in self.missing_platforms:
+            self.dirty.append(self.add_platform(platform, ctx))
+        for index in self.stale_outbounds:
+            self.add_outbound_reach(index)
+            self.dirty.extend(self.add_outbound(index))
+        for station in self.missing_labels:
+            self.dirty.append(self.add_label(station, ctx))
+        self.missing_platforms = set()
+        self.stale_outbounds = set()
+        self.missing_labels = set()
+        # Anything whose label might have gone near a change needs a rethink
+        for box in self.dirty:
+            if box is not None:
+                self.unplaced.update(self.reach.intersecting(box))
+        self.dirty = []
+        for station in sorted(self.unplaced, key=lambda station: station.code):
+            with self.map.timing("label placement", station.label_key):
+                self.place_station(station, ctx)
+        self.unplaced = set()
+
+    def place_station(self, station, ctx):
+        "Picks the best direction for one station's label."
+        if station in self.labels:
+            self.labels.remove(station)
+        options = [
+            (direction, station.label_bounds(ctx, direction))
+            for direction in self.candidates
+        ]
+        reach = None
+        for direction, bounds in options:
+            reach = union_bounds(reach, bounds)
+        self.reach.insert(station, reach)
+        # Route any track we could land on
+        for index in self.outbound_reach.intersecting(reach):
+            if index not in self.outbound_pieces:
+                self.add_outbound(index)
+        best = None
+        for preference, (direction, bounds) in enumerate(options):
+            cost = self.cost(bounds) + preference * self.preference_weight
+            if best is None or cost < best[0]:
+                best = (cost, direction, bounds)
+        cost, direction, bounds = best
+        if direction is not station.auto_label_direction:
+            station.auto_label_direction = direction
+            self.map.laid_out.pop(station.label_key, None)
+        self.labels.insert(station, bounds)
+
+    def cost(self, bounds):
+        "Returns how much a label with the given box covers up."
+        cost = 0
+        for other in self.labels.intersecting(bounds):
+            cost += overlap_area(bounds, self.labels.boxes[other]) * self.label_weight
+        for platform in self.platforms.intersecting(bounds):
+            cost += overlap_area(bounds, self.platforms.boxes[platform]) * self.platform_weight
+        # Track counts as its centre line widened to the white backing
+        padding = Segment.back_width / 2.0
+        padded = (
+            bounds[0] - padding,
+            bounds[1] - padding,
+            bounds[2] + padding,
+            bounds[3] + padding,
+        )
+        for item in self.track.intersecting(bounds):
+            start, end = self.track_lines[item]
+            cost += clipped_length(start, end, padded) * Segment.back_width * self.track_weight
+        return cost
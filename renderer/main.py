@@ -1,13 +1,45 @@
 import cairo
+import hashlib
+import marshal
 import os
+import re
+import shutil
 import sys
+import threading
 import argparse
 from vector import Vector
 from draw import Direction, Segment
-from datastructures import SortedDict
+from datastructures import OrderedMap
+from geometry import Element, MapGeometry, bounds_intersect, clip_bounds
+from labels import LabelPlacer
+from parallel import layout_in_parallel
+from profiling import Profiler, NOT_TIMING
+from spatial import GridIndex
+from store import MapStore
 from station import Station, Points, Depot, Sidings, DisusedStation
 
 
+# Bump this whenever a change would make the same input render differently.
+RENDERER_VERSION = "6"
+
+# Bump this whenever Map.parse's records change, to invalidate cached ones.
+PARSER_VERSION = "2"
+
+
+# Levels of detail for Map.layout(): everything, or just the lines and a
+# mark for each station for when the map is zoomed too far out to read.
+DETAIL_FULL = 0
+DETAIL_OVERVIEW = 1
+
+# What laying out each kind of element counts as when profiling
+LAYOUT_STAGES = {
+    "outbound": "track layout",
+    "platform": "platform layout",
+    "label": "label layout",
+    "mark": "mark layout",
+}
+
+
 class Line(object):
 
     def __init__(self, code, colors):
@@ -15,20 +47,109 @@ class Line(object):
         self.colors = colors
 
 
+STATION_CLASSES = {
+    "station": Station,
+    "waypoint": Points,
+    "depot": Depot,
+    "sidings": Sidings,
+    "disstation": DisusedStation,
+}
+STATION_TYPES = dict((cls, type) for type, cls in STATION_CLASSES.items())
+
+
+def station_line_code(line):
+    "Returns the code of the station a system file line defines, or None."
+    parts = line.split()
+    if len(parts) > 1 and parts[0] in STATION_CLASSES:
+        return parts[1]
+    return None
+
+
+def replace_coords(line, coords):
+    """
+    Returns a station's line from the system file with its coordinates (the
+    first thing after the code with a comma in) swapped for coords.
+    """
+    for match in list(re.finditer(r"\S+", line))[2:]:
+        if "," in match.group():
+            return line[:match.start()] + coords + line[match.end():]
+    raise ValueError("No coordinates in station line %r" % line)
+
+
 class Map(object):
 
     padding = 50
 
     def __init__(self):
-        pass
+        # Set to a profiling.Profiler to time loading, layout and drawing
+        self.profiler = None
+        # Set to a number of processes to lay out whole-map renders across
+        # (see parallel.py), or 0 for one per core
+        self.processes = None
+        # Station coordinates waiting to be written by save_offsets(), by
+        # code, and a lock so only one save writes the file at a time
+        self.unsaved = {}
+        self.unsaved_lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        # Where the routes of its track are kept; shared between maps unless
+        # one is given its own
+        self.route_cache = Segment.route_cache
+        # Goes up every time the map changes in a way that needs laying out
+        # again, so whether a layout is still current is cheap to check
+        self.version = 0
 
-    def load(self, filename):
-        self.stations = SortedDict()
-        self.lines = SortedDict()
-        self.extents = [0, 0, 0, 0]
-        self.outbounds = []
-        draw_last = []
-        draw_first = []
+    def timing(self, stage, key=None):
+        """
+        Returns a context manager that times its block for the profiler, if
+        there is one (see Profiler.timing()).
+        """
+        if self.profiler is None:
+            return NOT_TIMING
+        return self.profiler.timing(stage, key)
+
+    def load(self, filename, use_cache=True):
+        """
+        Loads the map from a system file. If there's an up-to-date compiled
+        cache of it alongside (matching its contents and this parser
+        version), that's used instead of parsing it; otherwise it's parsed
+        and the cache is (re)written.
+        """
+        with self.timing("load"):
+            self.load_file(filename, use_cache)
+
+    def load_file(self, filename, use_cache):
+        if not use_cache:
+            self.build(self.parse(filename))
+            return
+        with open(filename, "rb") as fh:
+            digest = hashlib.sha1(fh.read()).hexdigest()
+        key = (PARSER_VERSION, marshal.version, digest)
+        cache_filename = filename + ".cache"
+        try:
+            with open(cache_filename, "rb") as fh:
+                cached_key, tables = marshal.load(fh)
+            if cached_key == key:
+                self.restore(tables)
+                return
+        except (IOError, EOFError, ValueError, TypeError):
+            pass
+        self.build(self.parse(filename))
+        try:
+            with open(cache_filename + ".new", "wb") as fh:
+                marshal.dump((key, self.compile()), fh)
+            os.rename(cache_filename + ".new", cache_filename)
+        except (IOError, OSError):
+            # Read-only directory or similar; just go without.
+            pass
+
+    def parse(self, filename):
+        """
+        Reads a system file into a list of records - plain tuples of
+        strings and numbers, starting with the line number and type - with
+        everything worked out except references between them.
+        """
+        records = []
+        code = None
         with open(filename) as fh:
             for lineno, line in enumerate(fh):
                 line = line.strip()
@@ -45,14 +166,13 @@ class Map(object):
                             int(part[2:4], 16) / 255.0,
                             int(part[4:8], 16) / 255.0,
                         ) for part in parts[1].split(",")]
-                        self.lines[code] = Line(code, colors)
+                        records.append((lineno, type, code, colors))
 
                     # Track segment
                     elif type in ("track", "subtrack"):
                         # It's a station-to-station description
                         station_code, platform_number = parts[0].split("-", 1)
                         dest_code, dest_number = parts[1].split("-", 1)
-                        station = self.stations[station_code]
                         # Check for reverses
                         leaves_start = False
                         if platform_number[-1] == "!":
@@ -62,19 +182,17 @@ class Map(object):
                         if dest_number[-1] == "!":
                             finishes_end = True
                             dest_number = dest_number[:-1]
-                        # Add it
-                        try:
-                            self.add_outbound(
-                                station.platforms[platform_number],
-                                self.stations[dest_code].platforms[dest_number],
-                                self.lines[parts[2]],
-                                leaves_start = leaves_start,
-                                finishes_end = finishes_end,
-                                subtrack = (type == "subtrack"),
-                            )
-                        except:
-                            print "Error context: %s, %s" % (station, parts)
-                            raise
+                        records.append((
+                            lineno,
+                            type,
+                            station_code,
+                            platform_number,
+                            dest_code,
+                            dest_number,
+                            parts[2],
+                            leaves_start,
+                            finishes_end,
+                        ))
 
                     # Station/waypoint record
                     elif type in ("station", "waypoint", "depot", "sidings", "disstation"):
@@ -86,40 +204,21 @@ class Map(object):
                         name = " ".join(parts[1:index])
                         # Work out the coordinates
                         coord_parts = parts[index].split(",")
-                        coords = Vector(*map(float, coord_parts[-2:])) * 10
+                        x, y = map(float, coord_parts[-2:])
                         if len(coord_parts) == 3:
-                            relative_to = self.stations[coord_parts[0]]
+                            relative_code = coord_parts[0]
                         else:
-                            relative_to = None
-                        if type == "station":
-                            station_class = Station
-                        elif type == "depot":
-                            station_class = Depot
-                        elif type == "sidings":
-                            station_class = Sidings
-                        elif type == "disstation":
-                            station_class = DisusedStation
-                        else:
-                            station_class = Points
-                        last_station = self.stations[code] = station_class(
-                            code,
-                            name,
-                            coords,
-                            relative_to = relative_to,
-                        )
-                        self.extents[0] = min(coords.x, self.extents[0])
-                        self.extents[1] = max(coords.x, self.extents[1])
-                        self.extents[2] = min(coords.y, self.extents[2])
-                        self.extents[3] = max(coords.y, self.extents[3])
+                            relative_code = None
+                        records.append((lineno, type, code, name, x * 10, y * 10, relative_code))
 
                     # Platform record
                     elif type == "platform":
                         # Add a platform to the last station
-                        direction = getattr(Direction, parts[1])
+                        direction = getattr(Direction, parts[1]).direction
                         try:
-                            line = self.lines[parts[2]]
-                        except (IndexError, KeyError):
-                            line = self.lines["error"]
+                            line_code = parts[2]
+                        except IndexError:
+                            line_code = None
                         try:
                             platform_side_code = parts[3]
                             platform_side = {
@@ -130,93 +229,425 @@ class Map(object):
                             }[platform_side_code.upper()]
                         except IndexError:
                             platform_side = Segment.PLATFORM_BOTH
-                        self.stations[code].add_platform(parts[0], direction, line, platform_side)
+                        records.append((lineno, type, code, parts[0], direction, line_code, platform_side))
 
                     # Drawing order modifiers
                     elif type == "draw":
-                        if parts[0] == "first":
-                            draw_first.append(last_station)
-                        elif parts[0] == "last":
-                            draw_last.append(last_station)
-                        else:
+                        if parts[0] not in ("first", "last"):
                             raise ValueError("Unknown draw position %r" % parts[0])
+                        records.append((lineno, type, parts[0]))
 
                     # Label placement modifiers
                     elif type == "label":
-                        last_station.label_direction = getattr(Direction, parts[0])
+                        records.append((lineno, type, getattr(Direction, parts[0]).direction))
                     elif type == "label_offset":
-                        last_station.label_offset = Vector(map(int, parts[0].split(",")))
+                        x, y = map(int, parts[0].split(","))
+                        records.append((lineno, type, x, y))
 
                     # Unknown
                     else:
                         raise ValueError("Unknown line type %r" % type)
+        return records
+
+    def reset(self):
+        "Empties the map, ready to load into."
+        self.stations = OrderedMap()
+        self.lines = OrderedMap()
+        self.outbounds = []
+        # Which outbounds touch each platform, for re-laying out after moves
+        self.platform_outbounds = {}
+        # Laid-out Elements by key, and the order to draw those keys in
+        self.laid_out = {}
+        self.draw_order = None
+        self.label_placer = LabelPlacer(self)
+        # The same again for the overview level of detail
+        self.overview_laid_out = {}
+        self.overview_order = None
+        # Stations moved since the last save
+        self.moved = set()
+        self.version += 1
+
+    def build(self, records):
+        "Creates the lines, stations, platforms and track from parsed records."
+        self.reset()
+        draw_last = []
+        draw_first = []
+        last_station = None
+        for record in records:
+            type = record[1]
+            if type == "line":
+                lineno, type, code, colors = record
+                self.lines[code] = Line(code, [tuple(color) for color in colors])
+
+            elif type in ("track", "subtrack"):
+                lineno, type, station_code, platform_number, dest_code, dest_number, line_code, leaves_start, finishes_end = record
+                station = self.stations[station_code]
+                try:
+                    self.add_outbound(
+                        station.platforms[platform_number],
+                        self.stations[dest_code].platforms[dest_number],
+                        self.lines[line_code],
+                        leaves_start = leaves_start,
+                        finishes_end = finishes_end,
+                        subtrack = (type == "subtrack"),
+                    )
+                except:
+                    print "Error context: line %i, %s, %s" % (lineno + 1, station, record[2:])
+                    raise
+
+            elif type in STATION_CLASSES:
+                lineno, type, code, name, x, y, relative_code = record
+                coords = Vector(x, y)
+                if relative_code is not None:
+                    relative_to = self.stations[relative_code]
+                else:
+                    relative_to = None
+                last_station = self.stations[code] = STATION_CLASSES[type](
+                    code,
+                    name,
+                    coords,
+                    relative_to = relative_to,
+                )
+                last_station.lineno = lineno
+
+            elif type == "platform":
+                lineno, type, code, number, direction, line_code, platform_side = record
+                try:
+                    line = self.lines[line_code]
+                except KeyError:
+                    line = self.lines["error"]
+                self.stations[code].add_platform(number, Direction(direction), line, platform_side)
+
+            elif type == "draw":
+                if record[2] == "first":
+                    draw_first.append(last_station)
+                else:
+                    draw_last.append(last_station)
+
+            elif type == "label":
+                last_station.label_direction = Direction(record[2])
+            elif type == "label_offset":
+                last_station.label_offset = Vector(record[2], record[3])
+
         # Now reorder those with special draw clauses
         for station in draw_first:
-            self.stations.insert(0, station.code, station)
+            self.stations.move_to_end(station.code, last=False)
         for station in draw_last:
-            self.stations.insert(len(self.stations), station.code, station)
+            self.stations.move_to_end(station.code)
+        for station in self.stations.values():
+            station.place_platforms()
+        self.index_stations()
 
-    def save_offsets(self, filename):
+    def compile(self):
         """
-        Opens up the file, reads it, and writes new offsets if needs be.
+        Returns the loaded map as tables of plain values, with all the
+        references between things resolved to indexes and the platform
+        positions already worked out, for restore() to rebuild it from.
         """
-        with open(filename) as in_file:
-            with open(filename + ".new", "w") as out_file:
-                for lineno, line in enumerate(in_file):
-                    line = line.strip()
-                    parts = line.split()
-                    type = parts[0] if parts else None
-                    # What kind of line is it?
-                    if type in ("station", "waypoint", "depot", "sidings", "disstation"):
-                        # Get the code
-                        code = parts[1]
-                        # Get the real station
-                        station = self.stations[code]
-                        if station.relative_to:
-                            coords = "%s,%.1f,%.1f" % (
-                                station.relative_to.code,
-                                (station._offset.x // 5) / 2.0,
-                                (station._offset.y // 5) / 2.0,
-                            )
-                        else:
-                            coords = "%.1f,%.1f" % (
-                                (station._offset.x // 5) / 2.0,
-                                (station._offset.y // 5) / 2.0,
-                            )
-                        out_file.write("%(type)s %(code)s %(name)s %(coords)s\n" % {
-                            "type": type,
-                            "code": code,
-                            "name": station.name,
-                            "coords": coords,
-                        })
-                    else:
-                        out_file.write(line + "\n")
-        os.rename(filename + ".new", filename)
+        lines = self.lines.values()
+        line_ids = dict((line, index) for index, line in enumerate(lines))
+        # Stations go in the order they were made, so parents come first
+        stations = sorted(self.stations.values(), key=lambda station: station.lineno)
+        station_ids = dict((station, index) for index, station in enumerate(stations))
+        platforms = []
+        platform_ids = {}
+        for station in stations:
+            for platform in station.platforms.values():
+                platform_ids[platform] = len(platforms)
+                platforms.append((
+                    station_ids[station],
+                    platform.number,
+                    platform.direction.direction,
+                    line_ids[platform.line],
+                    platform.platform_side,
+                    platform.offset_number,
+                    platform.offset.x,
+                    platform.offset.y,
+                ))
+        return (
+            [(line.code, line.colors) for line in lines],
+            [(
+                STATION_TYPES[station.__class__],
+                station.code,
+                station.name,
+                station._offset.x,
+                station._offset.y,
+                station_ids[station.relative_to] if station.relative_to else None,
+                station.label_direction.direction if station.label_direction else None,
+                station.label_offset.x,
+                station.label_offset.y,
+                station.lineno,
+            ) for station in stations],
+            [station_ids[station] for station in self.stations.values()],
+            platforms,
+            [(
+                platform_ids[platform],
+                platform_ids[destination],
+                line_ids[line],
+                subtrack,
+                leaves_start,
+                finishes_end,
+            ) for platform, destination, line, subtrack, leaves_start, finishes_end in self.outbounds],
+        )
+
+    def restore(self, tables):
+        "Rebuilds the map from the tables made by compile()."
+        self.reset()
+        line_table, station_table, draw_order, platform_table, outbound_table = tables
+        lines = []
+        for code, colors in line_table:
+            lines.append(Line(code, [tuple(color) for color in colors]))
+            self.lines[code] = lines[-1]
+        stations = []
+        for type, code, name, x, y, relative_id, label_direction, label_x, label_y, lineno in station_table:
+            station = STATION_CLASSES[type](
+                code,
+                name,
+                Vector(x, y),
+                relative_to = stations[relative_id] if relative_id is not None else None,
+            )
+            if label_direction is not None:
+                station.label_direction = Direction(label_direction)
+            station.label_offset = Vector(label_x, label_y)
+            station.lineno = lineno
+            stations.append(station)
+        for station_id in draw_order:
+            station = stations[station_id]
+            self.stations[station.code] = station
+        platforms = []
+        for station_id, number, direction, line_id, platform_side, offset_number, x, y in platform_table:
+            station = stations[station_id]
+            direction = Direction(direction)
+            platform = station.platform_class(
+                station = station,
+                number = number,
+                direction = direction,
+                offset = Vector(x, y),
+                line = lines[line_id],
+                platform_side = platform_side,
+            )
+            platform.offset_number = offset_number
+            station.platforms[number] = platform
+            station.placed[direction.normalized] = station.placed.get(direction.normalized, 0) + 1
+            platforms.append(platform)
+        for platform_id, destination_id, line_id, subtrack, leaves_start, finishes_end in outbound_table:
+            self.add_outbound(
+                platforms[platform_id],
+                platforms[destination_id],
+                lines[line_id],
+                subtrack = subtrack,
+                leaves_start = leaves_start,
+                finishes_end = finishes_end,
+            )
+        self.index_stations()
+
+    def save_offsets(self, filename, background=False, on_error=None):
+        """
+        Writes the new positions of stations moved since the last save (or
+        left over from one that failed) back into the file. Only their
+        coordinates change; everything else, down to the spacing, is left
+        exactly as it was. The file is replaced in one go, so it's never
+        seen half-written.
+
+        With background=True the file is written by a new thread, which is
+        returned (or None if there's nothing to save). If on_error is given,
+        it's called (from that thread) with whatever the write raises,
+        rather than the thread dying with it.
+        """
+        with self.unsaved_lock:
+            if not self.moved and not self.unsaved:
+                return None
+            for station in self.moved:
+                self.unsaved[station.code] = (station.lineno, self.file_coords(station))
+        self.moved = set()
+        if background:
+            thread = threading.Thread(target=self.write_offsets_reporting, args=(filename, on_error))
+            thread.start()
+            return thread
+        self.write_offsets(filename)
+
+    def write_offsets_reporting(self, filename, on_error):
+        "Runs write_offsets(), handing anything it raises to on_error."
+        try:
+            self.write_offsets(filename)
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(error)
+
+    def file_coords(self, station):
+        "Returns a station's position as written in the system file."
+        x = (station._offset.x // 5) / 2.0
+        y = (station._offset.y // 5) / 2.0
+        if station.relative_to:
+            return "%s,%.1f,%.1f" % (station.relative_to.code, x, y)
+        return "%.1f,%.1f" % (x, y)
+
+    def write_offsets(self, filename):
+        """
+        Patches the coordinates waiting in unsaved into the file. Saves can
+        overlap, so each takes whatever's waiting when it gets to write,
+        which is always the latest position of each station.
+        """
+        with self.save_lock:
+            with self.unsaved_lock:
+                unsaved, self.unsaved = self.unsaved, {}
+            if not unsaved:
+                return
+            try:
+                with open(filename, "rb") as fh:
+                    lines = fh.readlines()
+                for code, (lineno, coords) in unsaved.items():
+                    lineno = self.find_station_line(lines, code, lineno)
+                    lines[lineno] = replace_coords(lines[lineno], coords)
+                with open(filename + ".new", "wb") as fh:
+                    fh.writelines(lines)
+                    fh.flush()
+                    os.fsync(fh.fileno())
+                shutil.copymode(filename, filename + ".new")
+                os.rename(filename + ".new", filename)
+            except:
+                # Keep them for next time, unless they've moved again since
+                with self.unsaved_lock:
+                    for code, value in unsaved.items():
+                        self.unsaved.setdefault(code, value)
+                raise
+
+    def find_station_line(self, lines, code, lineno):
+        """
+        Returns the index in lines of the station's definition, which is
+        normally still at lineno unless the file's been edited since.
+        """
+        if lineno is not None and lineno < len(lines) and station_line_code(lines[lineno]) == code:
+            return lineno
+        for lineno, line in enumerate(lines):
+            if station_line_code(line) == code:
+                return lineno
+        raise ValueError("Station %s is no longer in the file" % code)
+
+    def index_stations(self):
+        """
+        (Re)builds the packed store of station positions, and the spatial
+        index of them used for picking.
+        """
+        self.store = MapStore(self.stations.values())
+        self.station_index = GridIndex()
+        for station in self.stations.values():
+            self.station_index.insert(station, self.store.position(station))
+
+    @property
+    def extents(self):
+        """
+        [min x, max x, min y, max y] of the station coordinates as written,
+        including the origin.
+        """
+        return self.store.extents()
 
     def nearest_station(self, coords):
         """
         Finds the nearest station to the coords, and returns it along with the
         distance to it.
         """
-        nearest = (None, 100000000)
-        for station in self.stations.values():
-            distance = abs(station.offset - coords)
-            if distance < nearest[1]:
-                nearest = (station, distance)
-        return nearest
+        nearest = self.station_index.nearest(coords.tuple(), 1)
+        if nearest:
+            return nearest[0]
+        return (None, 100000000)
 
     def stations_inside_bounds(self, tl, br):
         """
-        Finds the nearest station to the coords, and returns it along with the
-        distance to it.
+        Yields the stations (not positioned relative to another) whose
+        positions are inside the box with corners tl and br.
         """
-        for station in self.stations.values():
-            if tl.x <= station.offset.x <= br.x and \
-               tl.y <= station.offset.y <= br.y:
-                if not station.relative_to:
-                    yield station
+        for station in self.station_index.within(tl.tuple(), br.tuple()):
+            if not station.relative_to:
+                yield station
+
+    def dependents(self, stations):
+        """
+        Returns the given stations plus everything positioned relative to
+        them, however indirectly.
+        """
+        result = set()
+        to_visit = list(stations)
+        while to_visit:
+            station = to_visit.pop()
+            if station not in result:
+                result.add(station)
+                to_visit.extend(station.relative_children)
+        return result
+
+    def evict_routes(self, stations):
+        """
+        Throws away cached routes touching the given stations (and anything
+        placed relative to them), ready for them to be moved.
+        """
+        points = []
+        for station in self.dependents(stations):
+            for platform in station.platforms.values():
+                points.append(platform.start_point)
+                points.append(platform.end_point)
+        self.route_cache.evict_points(points)
+
+    def invalidate(self, stations):
+        """
+        Throws away the laid-out track, platforms and labels that depend on
+        the positions of the given stations, so the next layout() redoes
+        just those.
+        """
+        stations = self.dependents(stations)
+        self.version += 1
+        self.label_placer.forget(stations)
+        for station in stations:
+            self.laid_out.pop(station.label_key, None)
+            self.overview_laid_out.pop(station.mark_key, None)
+            for platform in station.platforms.values():
+                self.laid_out.pop(platform.key, None)
+                self.overview_laid_out.pop(platform.key, None)
+                for index in self.platform_outbounds.get(platform, ()):
+                    self.laid_out.pop(("outbound", index), None)
+                    self.overview_laid_out.pop(("outbound", index), None)
+
+    def move_station(self, station, offset):
+        """
+        Moves a station to a new (relative) offset, invalidating only the
+        parts of the layout it affects.
+        """
+        self.evict_routes([station])
+        station.move(offset)
+        dependents = self.dependents([station])
+        self.store.move(station, offset.x, offset.y, dependents)
+        self.moved.add(station)
+        self.moved_in_store([station], dependents)
+
+    def translate_stations(self, stations, delta):
+        """
+        Moves the given stations, and everything placed relative to them,
+        along by delta in one go (as dragging a selection does), working
+        the new positions out in the store.
+        """
+        self.evict_routes(stations)
+        dependents = self.dependents(stations)
+        self.store.translate(stations, delta.x, delta.y, dependents)
+        for station in set(stations):
+            station.move(Vector(*self.store.offset(station)))
+            self.moved.add(station)
+        self.moved_in_store(stations, dependents)
+
+    def moved_in_store(self, stations, dependents):
+        """
+        Catches up with stations whose new positions are in the store:
+        re-indexes them and their dependents, and invalidates whatever
+        depends on them.
+        """
+        self.invalidate(stations)
+        for moved in dependents:
+            self.station_index.move(moved, self.store.position(moved))
 
     def add_outbound(self, platform, destination, line, subtrack=False, leaves_start=False, finishes_end=False):
+        index = len(self.outbounds)
+        self.platform_outbounds.setdefault(platform, []).append(index)
+        if destination is not platform:
+            self.platform_outbounds.setdefault(destination, []).append(index)
         self.outbounds.append((
             platform,
             destination,
@@ -226,16 +657,211 @@ class Map(object):
             finishes_end,
         ))
                             
-    def draw(self, ctx):
+    def detail_for_scale(self, scale):
+        """
+        Returns the level of detail to draw at when each unit of the map is
+        scale pixels across; labels are the first thing to become unreadable.
+        """
+        if Station.label_size * scale < 5:
+            return DETAIL_OVERVIEW
+        return DETAIL_FULL
+
+    def layout(self, ctx, bounds=None, detail=DETAIL_FULL):
+        """
+        Works out where everything on the map goes, and returns it as a
+        MapGeometry that can then be drawn as many times as needed. The
+        context is only used to measure label text.
+
+        Elements are kept between calls, so only those invalidated since
+        the last layout (see invalidate()) get worked out again. If bounds
+        are given as (x1, y1, x2, y2), only elements inside them are
+        included, and track that can't reach them isn't routed at all.
+
+        Automatic labels are only placed by a layout of the whole map; a
+        bounded one uses the directions from the last place_labels().
+
+        With detail=DETAIL_OVERVIEW, the lines are drawn with square corners
+        and without their white backs, platforms are just the line running
+        straight through, and there are no labels, just a mark for each
+        station. Each level keeps its own elements.
+        """
+        if detail == DETAIL_OVERVIEW:
+            laid_out = self.overview_laid_out
+            if self.overview_order is None:
+                self.overview_order = self.decide_overview_order()
+            draw_order = self.overview_order
+        else:
+            if bounds is None:
+                self.place_labels(ctx)
+            laid_out = self.laid_out
+            if self.draw_order is None:
+                self.draw_order = self.decide_draw_order()
+            draw_order = self.draw_order
+        elements = []
+        for key in draw_order:
+            if key in laid_out:
+                element = laid_out[key]
+            elif bounds is None or self.might_intersect(key, bounds):
+                element = laid_out[key] = self.layout_element(key, ctx, detail)
+            else:
+                continue
+            if element is not None:
+                if bounds is None or bounds_intersect(element.bounds, bounds):
+                    elements.append(element)
+        return MapGeometry.from_elements(elements)
+
+    def place_labels(self, ctx):
+        """
+        Picks directions for the labels that aren't given one, or just the
+        ones near whatever moved since the last time. This looks at track
+        all over the map, so it's done once per render rather than for
+        every clipped layout.
+        """
+        self.label_placer.place(ctx)
+
+    def might_intersect(self, key, bounds):
         """
-        Draws the entire map.
+        Cheaply works out if the element with the given key could end up
+        inside bounds, without laying it out. Only track is worth checking;
+        platforms and labels are cheap enough to lay out and test properly.
         """
+        if key[0] == "outbound":
+            return bounds_intersect(self.outbound_segment(key[1]).estimated_bounds(), bounds)
+        return True
+
+    def decide_draw_order(self):
+        """
+        Returns the keys of every Element in the order they're drawn.
+        Track comes first, with platforms appearing just before the first
+        piece of track that touches them; then any remaining platforms and
+        the labels, station by station.
+        """
+        order = []
+        seen = set()
+        for index, outbound in enumerate(self.outbounds):
+            for platform in outbound[:2]:
+                if platform not in seen:
+                    seen.add(platform)
+                    order.append(platform.key)
+            order.append(("outbound", index))
         for station in self.stations.values():
             for platform in station.platforms.values():
-                platform.drawn = False
-        self.draw_outbound(ctx)
+                if platform not in seen:
+                    seen.add(platform)
+                    order.append(platform.key)
+            order.append(station.label_key)
+        return order
+
+    def decide_overview_order(self):
+        """
+        Returns the keys of every overview Element in the order they're
+        drawn: the track and the platforms it runs through, then a mark
+        for each station on top.
+        """
+        order = [("outbound", index) for index in range(len(self.outbounds))]
+        for station in self.stations.values():
+            for platform in station.platforms.values():
+                order.append(platform.key)
         for station in self.stations.values():
-            station.draw(ctx)
+            order.append(station.mark_key)
+        return order
+
+    def element(self, key, ctx):
+        "Returns the Element with the given key, laying it out if needs be."
+        if key not in self.laid_out:
+            self.laid_out[key] = self.layout_element(key, ctx)
+        return self.laid_out[key]
+
+    def layout_element(self, key, ctx, detail=DETAIL_FULL):
+        "Lays out the single Element with the given key (which may be None)."
+        with self.timing(LAYOUT_STAGES.get(key[0], "layout"), key):
+            return self.layout_element_untimed(key, ctx, detail)
+
+    def layout_element_untimed(self, key, ctx, detail):
+        if key[0] == "outbound":
+            return self.layout_outbound(key[1], detail)
+        elif key[0] == "mark":
+            return self.stations[key[1]].layout_mark()
+        elif key[0] == "platform":
+            platform = self.stations[key[1]].platforms[key[2]]
+            if detail == DETAIL_OVERVIEW:
+                return platform.layout_overview()
+            return platform.layout()
+        elif key[0] == "label":
+            return self.stations[key[1]].layout_label(ctx)
+        else:
+            raise ValueError("Unknown element key %r" % (key, ))
+
+    def outbound_segment(self, index):
+        "Returns the Segment for the outbound track at index."
+        platform, destination, line, subtrack, leaves_start, finishes_end = self.outbounds[index]
+        # Make sure which ends we're using
+        if leaves_start:
+            start_point = platform.start_point
+            start_dir = platform.direction.opposite
+        else:
+            start_point = platform.end_point
+            start_dir = platform.direction
+        if finishes_end:
+            end_point = destination.end_point
+            end_dir = destination.direction.opposite
+        else:
+            end_point = destination.start_point
+            end_dir = destination.direction
+        segment = Segment(
+            start_point,
+            start_dir,
+            end_point,
+            end_dir,
+            line.colors,
+            subtrack = subtrack,
+        )
+        segment.route_cache = self.route_cache
+        return segment
+
+    def describe_outbound(self, index):
+        "Returns a description of the outbound track at index, for messages."
+        platform, destination, line = self.outbounds[index][:3]
+        return "%s-%s to %s-%s on %s" % (
+            platform.station.code,
+            platform.number,
+            destination.station.code,
+            destination.number,
+            line.code,
+        )
+
+    def unsolved_outbounds(self):
+        """
+        Returns the indexes of the outbound track that can't be routed on
+        the grid (and so is drawn heading straight for its end).
+        """
+        return [
+            index
+            for index in range(len(self.outbounds))
+            if not self.outbound_segment(index).route().solved
+        ]
+
+    def layout_outbound(self, index, detail=DETAIL_FULL):
+        "Returns the Element for the outbound track segment at index."
+        segment = self.outbound_segment(index)
+        # Solve the route up front, so that's timed separately
+        with self.timing("route solving", ("outbound", index)):
+            segment.route()
+        if detail == DETAIL_OVERVIEW:
+            return Element.from_strokes(("outbound", index), segment.layout_overview())
+        return Element.from_strokes(("outbound", index), segment.layout())
+
+    def draw(self, ctx):
+        """
+        Draws the entire map, or as much of it as is inside the clip region.
+        """
+        # The same box drawing culls against, so nothing it would draw is
+        # left out of layout
+        geometry = self.layout(ctx, clip_bounds(ctx))
+        if self.profiler is None:
+            geometry.draw(ctx)
+        else:
+            self.profiler.draw(ctx, geometry)
 
     def draw_debug(self, ctx, highlighted=set()):
         """
@@ -244,58 +870,82 @@ class Map(object):
         for station in self.stations.values():
             station.draw_debug(ctx, highlighted)
 
-    def draw_outbound(self, ctx):
-        # Draw outbound segments
-        for platform, destination, line, subtrack, leaves_start, finishes_end in self.outbounds:
-            # Draw the ends if they've not been done yet.
-            if not platform.drawn:
-                platform.draw(ctx)
-            if not destination.drawn:
-                destination.draw(ctx)
-            # Make sure which ends we're using
-            if leaves_start:
-                start_point = platform.start_point
-                start_dir = platform.direction.left.left.left.left
-            else:
-                start_point = platform.end_point
-                start_dir = platform.direction
-            if finishes_end:
-                end_point = destination.end_point
-                end_dir = destination.direction.left.left.left.left
-            else:
-                end_point = destination.start_point
-                end_dir = destination.direction
-            # Draw!
-            Segment(
-                start_point,
-                start_dir,
-                end_point,
-                end_dir,
-                line.colors,
-                subtrack = subtrack,
-            ).draw(ctx)
+    def size(self):
+        "Returns the (width, height) of the rendered map."
+        x1, x2, y1, y2 = self.extents
+        return (
+            (x2 - x1) + self.padding * 2,
+            (y2 - y1) + self.padding * 2,
+        )
 
-    def to_pdf(self, filename):
-        width = (self.extents[1] - self.extents[0]) + self.padding * 2
-        height = (self.extents[3] - self.extents[2]) + self.padding * 2
-        surface = cairo.PDFSurface(filename, width, height)
+    def render_to(self, surface):
+        "Draws the map onto a surface the size given by size()."
         ctx = cairo.Context(surface)
+        x1, x2, y1, y2 = self.extents
         ctx.translate(
-            self.padding - self.extents[0],
-            self.padding - self.extents[2],
+            self.padding - x1,
+            self.padding - y1,
         )
+        if self.processes is not None:
+            with self.timing("parallel layout"):
+                layout_in_parallel(self, ctx, self.processes)
+        self.place_labels(ctx)
         self.draw(ctx)
+        return ctx
+
+    def to_pdf(self, filename):
+        surface = cairo.PDFSurface(filename, *self.size())
+        self.render_to(surface)
+        surface.finish()
+
+    def to_svg(self, filename):
+        surface = cairo.SVGSurface(filename, *self.size())
+        self.render_to(surface)
         surface.finish()
 
+    def to_png(self, filename):
+        width, height = self.size()
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height))
+        # PNGs get a white background rather than transparency
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.paint()
+        self.render_to(surface)
+        surface.write_to_png(filename)
+
+    def render(self, filename, format=None):
+        "Renders to a file, in the format given or implied by its extension."
+        if format is None:
+            format = os.path.splitext(filename)[1][1:].lower()
+        try:
+            method = {
+                "pdf": self.to_pdf,
+                "svg": self.to_svg,
+                "png": self.to_png,
+            }[format]
+        except KeyError:
+            raise ValueError("Unknown output format %r" % format)
+        with self.timing("output"):
+            method(filename)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate a Twin Tubes map")
     parser.add_argument('in_file', help='The source file for the map')
-    parser.add_argument('-o', '--out-file', help='The output file name')
+    parser.add_argument('-o', '--out-file', help='The output file name (.pdf, .svg or .png)')
+    parser.add_argument('-p', '--profile', type=int, nargs='?', const=10, metavar='N', help='Report time taken by each stage, and the N most expensive stations and track (default 10)')
+    parser.add_argument('-j', '--processes', type=int, nargs='?', const=0, metavar='N', help='Lay out track and labels across N processes (default one per core)')
     args = parser.parse_args()
     if args.out_file == None:
         args.out_file = os.path.splitext(args.in_file)[0] + '.pdf'
 
     m = Map()
+    m.processes = args.processes
+    if args.profile is not None:
+        m.profiler = Profiler()
     m.load(args.in_file)
-    m.to_pdf(args.out_file)
+    m.render(args.out_file)
+    for index in m.unsolved_outbounds():
+        print "Couldn't route track from %s" % m.describe_outbound(index)
+    if m.profiler is not None:
+        print m.profiler.report(m, args.profile)
@@ -0,0 +1,120 @@
+"""
+Lays out a whole map across a pool of processes.
+
+Once the stations are in place, routing and laying out each piece of track,
+laying out each platform and working out where each label could go are all
+independent of each other, so they're shared out between the processes in
+chunks and the results put back into the map's caches. The rest of layout -
+picking label directions, which depends on the labels already placed, and
+putting the elements in draw order - then runs as normal and finds all the
+work done, so the output is exactly what laying out in one process gives.
+
+Only that shared-out part gets any faster. Choosing labels, putting the
+results back and drawing all stay in this process, and on a 10k station
+system they're most of the time, so more processes soon stop helping. With
+only one process (or one core) to use, nothing is shared out at all, and
+layout just runs as normal.
+
+The workers are forked with the map already in memory, so this needs a
+system with fork(). Label text is measured up front, in this process, so
+nothing depends on the workers' cairo setup.
+"""
+
+import gc
+import multiprocessing
+
+
+def init_worker(map):
+    global worker_map
+    worker_map = map
+    # Timings from the workers would never get back to the profiler
+    worker_map.profiler = None
+
+
+def layout_worker(jobs):
+    """
+    Does a chunk of jobs, returning a result for each: an outbound's Element
+    and Route, a platform's Element, or a station's label anchors by
+    direction.
+    """
+    results = []
+    for job in jobs:
+        if job[0] == "anchors":
+            station = worker_map.stations[job[1]]
+            results.append(dict(
+                (direction, station.label_anchor(None, direction))
+                for direction in job[2]
+            ))
+        elif job[0] == "outbound":
+            element = worker_map.layout_element(job, None)
+            results.append((element, worker_map.outbound_segment(job[1]).route()))
+        else:
+            results.append(worker_map.layout_element(job, None))
+    return results
+
+
+def layout_in_parallel(map, ctx, processes=None):
+    """
+    Fills in the map's laid out elements (at full detail), routes and label
+    anchors for everything not already done, using processes processes (or
+    one per core). With just one process, or one core, it leaves it all for
+    the normal layout. The context is only used to measure label text.
+    """
+    cores = multiprocessing.cpu_count()
+    processes = processes or cores
+    if processes < 2 or cores < 2:
+        # Forking and sending it all back would only be extra work
+        return
+    jobs = []
+    for index in range(len(map.outbounds)):
+        if ("outbound", index) not in map.laid_out:
+            jobs.append(("outbound", index))
+    for station in map.stations.values():
+        for platform in station.platforms.values():
+            if platform.key not in map.laid_out:
+                jobs.append(platform.key)
+    # Once labels have been placed, their anchors are already worked out
+    if not map.label_placer.started:
+        for station in map.stations.values():
+            if station.name:
+                station.measure_label(ctx)
+                if station.label_direction:
+                    directions = [station.label_direction]
+                else:
+                    directions = map.label_placer.candidates
+                jobs.append(("anchors", station.code, directions))
+    if not jobs:
+        return
+    # Several chunks per process, so they all finish at about the same time
+    size = max(len(jobs) // (processes * 8), 1)
+    chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+    # Everything sent back is new and acyclic, so the collector would only
+    # be walking the whole map again and again as it arrives (and in the
+    # workers, which are forked with it held off too).
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        pool = multiprocessing.Pool(
+            processes,
+            initializer = init_worker,
+            initargs = (map, ),
+        )
+        try:
+            results = pool.map(layout_worker, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        # Put it all back, in order
+        for chunk, chunk_results in zip(chunks, results):
+            for job, result in zip(chunk, chunk_results):
+                if job[0] == "anchors":
+                    map.stations[job[1]]._label_anchors.update(result)
+                elif job[0] == "outbound":
+                    element, route = result
+                    map.route_cache.add(map.outbound_segment(job[1]).route_key(), route)
+                    map.laid_out[job] = element
+                else:
+                    map.laid_out[job] = result
+    finally:
+        if collecting:
+            gc.enable()
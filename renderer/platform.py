@@ -1,10 +1,12 @@
 from draw import Segment
+from geometry import Element, Path, Stroke, point_bounds
 
 
 class Platform(object):
 
     length = 22
     color = (0.5, 0.5, 0.5)
+    dashed = False
 
     def __init__(self, station, number, direction, offset, platform_side, line):
         self.station = station
@@ -13,30 +15,41 @@ class Platform(object):
         self.offset = offset
         self.line = line
         self.platform_side = platform_side
-        self.drawn = False
         # Calculate positions
         self.half_length = self.direction.vector * (self.length / 2.0)
+        # The absolute (start, mid, end) points, worked out when first
+        # needed; the station resets this when it or the platform moves
+        self._points = None
+
+    def work_out_points(self):
+        mid = self.station.offset + self.offset
+        self._points = (mid - self.half_length, mid, mid + self.half_length)
+        return self._points
 
     @property
     def start_point(self):
-        return self.station.offset + self.offset - self.half_length
+        return (self._points or self.work_out_points())[0]
 
     @property
     def end_point(self):
-        return self.station.offset + self.offset + self.half_length
+        return (self._points or self.work_out_points())[2]
 
     @property
     def mid_point(self):
-        return self.station.offset + self.offset
+        return (self._points or self.work_out_points())[1]
 
     def __repr__(self):
         return "<Platform %s %s>" % (self.number, self.station)
 
-    def draw(self, ctx):
-        "Draws this platform on the map"
+    @property
+    def key(self):
+        return ("platform", self.station.code, self.number)
+
+    def layout(self):
+        "Returns the Element that draws this platform, or None."
         # Draw the main platform segment
         if self.line.code != "none":
-            Segment(
+            return Element.from_strokes(self.key, Segment(
                 self.start_point,
                 self.direction,
                 self.end_point,
@@ -44,8 +57,25 @@ class Platform(object):
                 self.line.colors,
                 platform = self.platform_side,
                 platform_color = self.color,
-            ).draw(ctx)
-        self.drawn = True
+            ).layout())
+
+    def layout_overview(self):
+        """
+        Returns the Element that draws this platform when zoomed well out -
+        just the line running straight along it, so the track either side
+        joins up - or None.
+        """
+        if self.length and self.line.code != "none":
+            start = self.start_point.tuple()
+            end = self.end_point.tuple()
+            return Element.from_strokes(self.key, [Stroke(
+                Path([("move_to", ) + start], point_bounds([start])),
+                end,
+                None,
+                self.line.colors[0],
+                Segment.width,
+                self.dashed,
+            )])
 
 
 class PointsPlatform(Platform):
@@ -53,20 +83,21 @@ class PointsPlatform(Platform):
 
     length = 0
 
-    def draw(self, ctx):
-        "Draws this platform on the map"
-        pass
+    def layout(self):
+        "Points aren't drawn at all"
+        return None
 
 
 class DepotPlatform(Platform):
     "Long dashed platform for depots."
 
     length = 14
+    dashed = True
 
-    def draw(self, ctx):
-        "Draws this platform on the map"
+    def layout(self):
+        "Returns the Element that draws this platform, or None."
         if self.line.code != "none":
-            Segment(
+            return Element.from_strokes(self.key, Segment(
                 self.start_point,
                 self.direction,
                 self.end_point,
@@ -74,8 +105,7 @@ class DepotPlatform(Platform):
                 self.line.colors,
                 platform = 0,
                 dashed = True,
-            ).draw(ctx)
-        self.drawn = True
+            ).layout())
 
 
 class SidingsPlatform(DepotPlatform):
@@ -0,0 +1,222 @@
+"""
+Profiling of map loading, layout and drawing.
+
+Give a Map a Profiler (as map.profiler) and it records how long each stage
+takes, and how much of that went on each element - so it can say which
+stations and stretches of track are the slow ones, and draw that as a
+heatmap over the map.
+"""
+
+import gc
+import math
+import time
+import cairo
+from contextlib import contextmanager
+from draw import RouteCache, Segment
+
+
+# The stages timed, in the order they're reported
+STAGES = [
+    "load",
+    "parallel layout",
+    "platform layout",
+    "route solving",
+    "track layout",
+    "label placement",
+    "label layout",
+    "mark layout",
+    "drawing",
+    "output",
+]
+
+
+class NotTiming(object):
+    "Stands in for Profiler.timing() when there's no profiler."
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NOT_TIMING = NotTiming()
+
+
+class Profiler(object):
+    """
+    Adds up the time spent in each stage, and on each element (by key) within
+    them. Timings nest, and time is only counted against the innermost one,
+    so e.g. routing done while placing labels counts as route solving.
+
+    The garbage collector is held off while anything's being timed, as
+    otherwise its pauses get blamed on whatever element happened to set it
+    off, and make that look like the most expensive thing on the map.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.calls = {}
+        self.costs = {}
+        # [start time, time taken by nested timings] for each open timing
+        self.stack = []
+        # Where each outbound's track ran and each station was, by
+        # outbound index and station code, as of keep_positions()
+        self.outbound_paths = {}
+        self.station_positions = {}
+
+    @contextmanager
+    def timing(self, stage, key=None):
+        "Times the with block as part of stage, and of element key if given."
+        if not self.stack:
+            collecting = gc.isenabled()
+            gc.disable()
+        entry = [time.time(), 0]
+        self.stack.append(entry)
+        try:
+            yield
+        finally:
+            self.stack.pop()
+            taken = time.time() - entry[0]
+            if self.stack:
+                self.stack[-1][1] += taken
+            elif collecting:
+                gc.enable()
+            self.add(stage, key, taken - entry[1])
+
+    def add(self, stage, key, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        if key is not None:
+            self.costs[key] = self.costs.get(key, 0) + seconds
+
+    def draw(self, ctx, geometry):
+        """
+        Draws a MapGeometry one element at a time, rather than in batches as
+        usual, so each element's share of the drawing can be timed. For
+        vector surfaces most of the real work happens when they're finished,
+        which is counted as output.
+        """
+        for element in geometry.elements:
+            with self.timing("drawing", element.key):
+                element.draw(ctx)
+
+    def station_costs(self):
+        "Returns {station code: seconds} for its platforms, label and mark."
+        result = {}
+        for key, seconds in self.costs.items():
+            if key[0] != "outbound":
+                result[key[1]] = result.get(key[1], 0) + seconds
+        return result
+
+    def outbound_costs(self):
+        "Returns {outbound index: seconds} for each piece of track."
+        return dict(
+            (key[1], seconds)
+            for key, seconds in self.costs.items()
+            if key[0] == "outbound"
+        )
+
+    def report(self, map, top=10):
+        """
+        Returns a summary of the time taken by each stage, followed by the
+        top most expensive stations and pieces of track, as a string.
+        """
+        lines = ["%-20s %10s %8s" % ("stage", "seconds", "calls")]
+        for stage in STAGES + sorted(set(self.stages) - set(STAGES)):
+            if stage in self.stages:
+                lines.append("%-20s %10.4f %8i" % (stage, self.stages[stage], self.calls[stage]))
+        lines.append("%-20s %10.4f" % ("total", sum(self.stages.values())))
+        lines.append("")
+        lines.append("Most expensive stations:")
+        for code, seconds in most_expensive(self.station_costs(), top):
+            station = map.stations.get(code)
+            lines.append("%10.2fms  %s %s" % (seconds * 1000, code, station.name if station else "(gone)"))
+        lines.append("")
+        lines.append("Most expensive track:")
+        for index, seconds in most_expensive(self.outbound_costs(), top):
+            route = map.outbound_segment(index).route()
+            lines.append("%10.2fms  %s (%i corners%s)" % (
+                seconds * 1000,
+                map.describe_outbound(index),
+                len(route.path),
+                "" if route.solved else ", unsolved",
+            ))
+        return "\n".join(lines)
+
+    def keep_positions(self, map):
+        """
+        Remembers where the map's track and stations are, so the heatmap
+        can be drawn without touching the map again (from another thread,
+        say).
+        """
+        self.outbound_paths = dict(
+            (index, [corner.tuple() for corner, dir in map.outbound_segment(index).route().path])
+            for index in range(len(map.outbounds))
+        )
+        self.station_positions = dict(
+            (station.code, station.offset.tuple())
+            for station in map.stations.values()
+        )
+
+    def draw_heatmap(self, ctx):
+        """
+        Draws the costs over the map, as it was at keep_positions(): each
+        piece of track is traced over, and each station gets a blob, from a
+        faint yellow for the cheapest up to a solid red for the most
+        expensive thing on the map.
+        """
+        stations = self.station_costs()
+        outbounds = self.outbound_costs()
+        highest = max(stations.values() + outbounds.values() + [0])
+        if not highest:
+            return
+        ctx.save()
+        ctx.set_line_cap(cairo.LINE_CAP_ROUND)
+        ctx.set_line_join(cairo.LINE_JOIN_ROUND)
+        ctx.set_line_width(Segment.back_width * 3)
+        # Hottest last, so it's on top
+        for index, seconds in sorted(outbounds.items(), key=lambda (index, seconds): seconds):
+            path = self.outbound_paths.get(index)
+            if path is not None:
+                ctx.move_to(*path[0])
+                for corner in path[1:]:
+                    ctx.line_to(*corner)
+                set_heat(ctx, seconds / highest)
+                ctx.stroke()
+        for code, seconds in sorted(stations.items(), key=lambda (code, seconds): seconds):
+            position = self.station_positions.get(code)
+            if position is not None:
+                ctx.new_path()
+                ctx.arc(position[0], position[1], 15, 0, math.pi * 2)
+                set_heat(ctx, seconds / highest)
+                ctx.fill()
+        ctx.restore()
+
+
+def most_expensive(costs, top):
+    "Returns the top (thing, seconds) pairs from costs, most expensive first."
+    return sorted(costs.items(), key=lambda (thing, seconds): -seconds)[:top]
+
+
+def set_heat(ctx, heat):
+    "Sets the source to the heatmap colour for heat (from 0 to 1)."
+    ctx.set_source_rgba(1, 1 - heat, 0, 0.15 + heat * 0.6)
+
+
+def profile_map(map):
+    """
+    Gives the map a fresh Profiler, and a route cache of its own, then lays
+    out and draws all of it again from scratch so everything gets measured
+    (without throwing away routes any other map is using). Returns the
+    Profiler, which is left attached to time any layout done later too, and
+    remembers where everything was for draw_heatmap().
+    """
+    profiler = map.profiler = Profiler()
+    map.route_cache = RouteCache()
+    map.invalidate(map.stations.values())
+    width, height = map.size()
+    with profiler.timing("output"):
+        map.render_to(cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height)))
+    profiler.keep_positions(map)
+    return profiler
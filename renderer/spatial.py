@@ -0,0 +1,240 @@
+"""
+Spatial indexing, for finding things on the map without looking at all of
+them.
+"""
+
+import heapq
+import math
+
+
+class GridIndex(object):
+    """
+    A uniform grid of buckets over items with (x, y) positions. Supports
+    rectangle and k-nearest queries, and moving items about cheaply.
+
+    Items remember the order they were first inserted in, so those at the
+    same distance come back from nearest() in that order.
+    """
+
+    cell_size = 100
+
+    def __init__(self, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.cells = {}
+        self.positions = {}
+        # Insertion order, by item
+        self.sequence = {}
+        self.inserted = 0
+        # Range of cells ever used, as (min_cx, min_cy, max_cx, max_cy)
+        self.cell_extents = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, item):
+        return item in self.positions
+
+    def cell_for(self, x, y):
+        return (
+            int(math.floor(x / float(self.cell_size))),
+            int(math.floor(y / float(self.cell_size))),
+        )
+
+    def insert(self, item, point):
+        "Adds an item at the given (x, y) point."
+        if item in self.positions:
+            self.unbucket(item)
+        x, y = point
+        if item not in self.sequence:
+            self.sequence[item] = self.inserted
+            self.inserted += 1
+        self.positions[item] = (x, y)
+        cell = self.cell_for(x, y)
+        self.cells.setdefault(cell, set()).add(item)
+        if self.cell_extents is None:
+            self.cell_extents = cell + cell
+        else:
+            min_cx, min_cy, max_cx, max_cy = self.cell_extents
+            self.cell_extents = (
+                min(min_cx, cell[0]),
+                min(min_cy, cell[1]),
+                max(max_cx, cell[0]),
+                max(max_cy, cell[1]),
+            )
+
+    def remove(self, item):
+        self.unbucket(item)
+        del self.sequence[item]
+
+    def unbucket(self, item):
+        "Takes an item out of its cell, keeping its place in the order."
+        x, y = self.positions.pop(item)
+        cell = self.cell_for(x, y)
+        bucket = self.cells[cell]
+        bucket.discard(item)
+        if not bucket:
+            del self.cells[cell]
+
+    def move(self, item, point):
+        "Moves an item to a new point, only touching buckets if it changes cell."
+        x, y = point
+        old_x, old_y = self.positions[item]
+        old_cell = self.cell_for(old_x, old_y)
+        new_cell = self.cell_for(x, y)
+        if old_cell != new_cell:
+            self.unbucket(item)
+            self.insert(item, point)
+        else:
+            self.positions[item] = (x, y)
+
+    def within(self, tl, br):
+        "Yields the items inside the box with corners tl and br (inclusive)."
+        min_cx, min_cy = self.cell_for(tl[0], tl[1])
+        max_cx, max_cy = self.cell_for(br[0], br[1])
+        # Big boxes are better served by walking the occupied cells
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self.cells):
+            cells = [
+                bucket for (cx, cy), bucket in self.cells.items()
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy
+            ]
+        else:
+            cells = []
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    bucket = self.cells.get((cx, cy))
+                    if bucket:
+                        cells.append(bucket)
+        for bucket in cells:
+            for item in bucket:
+                x, y = self.positions[item]
+                if tl[0] <= x <= br[0] and tl[1] <= y <= br[1]:
+                    yield item
+
+    def nearest(self, point, k=1):
+        """
+        Returns up to k (item, distance) pairs closest to the point, nearest
+        first, with ties in insertion order. Searches outwards in rings of
+        cells until nothing closer can turn up.
+        """
+        if not self.positions:
+            return []
+        x, y = point
+        cx, cy = self.cell_for(x, y)
+        # There's nothing beyond the furthest cell ever used
+        min_cx, min_cy, max_cx, max_cy = self.cell_extents
+        last_ring = max(cx - min_cx, max_cx - cx, cy - min_cy, max_cy - cy)
+        best = []
+        ring = 0
+        while ring <= last_ring:
+            for cell in self.ring_cells(cx, cy, ring):
+                for item in self.cells.get(cell, ()):
+                    ix, iy = self.positions[item]
+                    distance = ((ix - x) ** 2 + (iy - y) ** 2) ** 0.5
+                    # Negated so the heap top is the furthest (and latest)
+                    # of the best
+                    entry = (-distance, -self.sequence[item], item)
+                    if len(best) < k:
+                        heapq.heappush(best, entry)
+                    elif entry > best[0]:
+                        heapq.heapreplace(best, entry)
+            # Anything in the next ring is at least this far away
+            if len(best) == k and ring * self.cell_size >= -best[0][0]:
+                break
+            ring += 1
+        return [(item, -distance) for distance, _, item in sorted(best, reverse=True)]
+
+    def ring_cells(self, cx, cy, ring):
+        "Yields the cells exactly ring steps (in Chebyshev distance) from a cell."
+        if ring == 0:
+            yield (cx, cy)
+            return
+        for dx in range(-ring, ring + 1):
+            yield (cx + dx, cy - ring)
+            yield (cx + dx, cy + ring)
+        for dy in range(-ring + 1, ring):
+            yield (cx - ring, cy + dy)
+            yield (cx + ring, cy + dy)
+
+
+class BoxIndex(object):
+    """
+    A uniform grid of buckets over items with (x1, y1, x2, y2) boxes. Each
+    item goes in every cell its box touches, so overlap queries only have
+    to look at nearby items.
+    """
+
+    cell_size = 100
+
+    def __init__(self, cell_size=None):
+        if cell_size is not None:
+            self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = {}
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def __contains__(self, item):
+        return item in self.boxes
+
+    def cell_range(self, bounds):
+        "Returns (min_cx, min_cy, max_cx, max_cy) for the cells under a box."
+        size = float(self.cell_size)
+        return (
+            int(math.floor(bounds[0] / size)),
+            int(math.floor(bounds[1] / size)),
+            int(math.floor(bounds[2] / size)),
+            int(math.floor(bounds[3] / size)),
+        )
+
+    def insert(self, item, bounds):
+        "Adds an item covering the given box."
+        if item in self.boxes:
+            self.remove(item)
+        self.boxes[item] = bounds
+        min_cx, min_cy, max_cx, max_cy = self.cell_range(bounds)
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                self.cells.setdefault((cx, cy), set()).add(item)
+
+    def remove(self, item):
+        bounds = self.boxes.pop(item)
+        min_cx, min_cy, max_cx, max_cy = self.cell_range(bounds)
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                bucket = self.cells[(cx, cy)]
+                bucket.discard(item)
+                if not bucket:
+                    del self.cells[(cx, cy)]
+
+    def move(self, item, bounds):
+        "Gives an item a new box."
+        if self.boxes.get(item) != bounds:
+            self.insert(item, bounds)
+
+    def intersecting(self, bounds):
+        "Returns the set of items whose boxes overlap the given one."
+        min_cx, min_cy, max_cx, max_cy = self.cell_range(bounds)
+        # Big boxes are better served by walking the occupied cells
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self.cells):
+            buckets = [
+                bucket for (cx, cy), bucket in self.cells.items()
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy
+            ]
+        else:
+            buckets = []
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    bucket = self.cells.get((cx, cy))
+                    if bucket:
+                        buckets.append(bucket)
+        result = set()
+        x1, y1, x2, y2 = bounds
+        for bucket in buckets:
+            for item in bucket:
+                if item not in result:
+                    bx1, by1, bx2, by2 = self.boxes[item]
+                    if bx1 <= x2 and x1 <= bx2 and by1 <= y2 and y1 <= by2:
+                        result.add(item)
+        return result
@@ -1,10 +1,59 @@
 import cairo
-from datastructures import SortedDict
+from datastructures import OrderedMap
 from draw import Segment, Direction
+from geometry import Element, Label, Path, Stroke, point_bounds, set_label_font, union_bounds
 from platform import Platform, PointsPlatform, DepotPlatform, SidingsPlatform, DisusedPlatform
 from vector import Vector
 
 
+class TextMetrics(object):
+    """
+    Remembers text measurements and shaped glyphs by (font face, size,
+    text), as measuring text is by far the slowest part of laying out
+    labels. Metrics are unhinted (see set_label_font()), so they don't
+    depend on the scale the context was at when they were taken.
+    """
+
+    def __init__(self):
+        self.texts = {}
+        self.fonts = {}
+
+    def set_font(self, ctx, face, size):
+        set_label_font(ctx, face, size)
+
+    def font_extents(self, ctx, face, size):
+        "Returns the font_extents() of the font."
+        key = (face, size)
+        if key not in self.fonts:
+            ctx.save()
+            self.set_font(ctx, face, size)
+            self.fonts[key] = ctx.font_extents()
+            ctx.restore()
+        return self.fonts[key]
+
+    def text(self, ctx, face, size, text):
+        """
+        Returns the (x_bearing, y_bearing, width, height) of the text, and
+        its glyphs as a tuple of (index, x, y) drawn from the origin - or
+        None if this cairo can't shape text for us.
+        """
+        key = (face, size, text)
+        if key not in self.texts:
+            ctx.save()
+            self.set_font(ctx, face, size)
+            extents = tuple(ctx.text_extents(text)[:4])
+            try:
+                glyphs = tuple([
+                    (glyph[0], glyph[1], glyph[2])
+                    for glyph in ctx.get_scaled_font().text_to_glyphs(0, 0, text, False)
+                ])
+            except AttributeError:
+                glyphs = None
+            ctx.restore()
+            self.texts[key] = (extents, glyphs)
+        return self.texts[key]
+
+
 class Station(object):
     """
     A place on the map that lines go to and from.
@@ -13,28 +62,75 @@ class Station(object):
     station_gap = 10
     platform_class = Platform
     label_color = (0, 51 / 255.0, 102 / 255.0)
+    label_font = "LondonTwo"
     label_size = 12
     label_distance = Vector(6, 4)
+    label_metrics = TextMetrics()
+    # The tick drawn across the platforms when zoomed well out
+    mark_length = 12
+    mark_width = 4
 
     def __init__(self, code, name, offset, relative_to=None):
         self.code = code
         self.name = name
+        # Position relative to relative_to (change it with move()), and the
+        # absolute position, worked out when first needed
         self._offset = offset
+        self._position = None
         self.relative_to = relative_to
-        self.platforms = SortedDict()
-        self.placed = SortedDict()
+        # Stations positioned relative to this one
+        self.relative_children = []
+        if relative_to:
+            relative_to.relative_children.append(self)
+        self.platforms = OrderedMap()
+        # How many platforms face each (normalised) direction
+        self.placed = {}
+        # Label positions relative to the station by direction, from
+        # anchor_label()
+        self._label_anchors = {}
+        # The direction given in the file, and the one the LabelPlacer
+        # picked if there wasn't one
         self.label_direction = None
+        self.auto_label_direction = None
         self.label_offset = Vector(0, 0)
+        # Where in the source file it was defined
+        self.lineno = None
 
     @property
     def offset(self):
-        if self.relative_to:
-            return self.relative_to.offset + self._offset
-        else:
-            return self._offset
+        """
+        The station's absolute position. It's remembered, so stations placed
+        relative to others don't go up the chain every time.
+        """
+        if self._position is None:
+            if self.relative_to:
+                self._position = self.relative_to.offset + self._offset
+            else:
+                self._position = self._offset
+        return self._position
+
+    def move(self, offset):
+        "Moves the station to a new offset relative to relative_to."
+        self._offset = offset
+        self.forget_position()
+
+    def forget_position(self):
+        """
+        Throws away the remembered absolute positions of the station, its
+        platforms and everything placed relative to it.
+        """
+        self._position = None
+        for platform in self.platforms.values():
+            platform._points = None
+        for child in self.relative_children:
+            child.forget_position()
 
     def add_platform(self, number, direction, line, platform_side):
-        # Work out its coords
+        """
+        Adds a platform, noting its place in the row of platforms facing
+        the same way. Where the rows go is only worked out by
+        place_platforms(), which must be called once they're all added.
+        """
         norm_direction = direction.normalized
         self.placed[norm_direction] = self.placed.get(norm_direction, 0) + 1
         # Make it
@@ -47,7 +143,10 @@ class Station(object):
             platform_side = platform_side,
         )
         self.platforms[number].offset_number = self.placed[norm_direction] - 1
-        # Recalculate all platform locations
+
+    def place_platforms(self):
+        "Works out where each platform goes, with each row centred on the station."
+        self._label_anchors = {}
         for platform in self.platforms.values():
             norm_direction = platform.direction.normalized
             platform.offset = (
@@ -55,23 +154,50 @@ class Station(object):
                 (platform.offset_number + 0.5 - (self.placed[norm_direction] / 2.0)) *
                 self.station_gap
             )
+            platform._points = None
 
     def __repr__(self):
         return "<Station %s (%s)>" % (self.code, self.name)
 
-    def decide_label_direction(self):
-        self.label_direction = Direction.W
+    @property
+    def shown_label_direction(self):
+        "The direction the label is drawn in."
+        return self.label_direction or self.auto_label_direction or Direction.W
+
+    @property
+    def label_key(self):
+        return ("label", self.code)
 
-    def draw(self, ctx):
+    @property
+    def mark_key(self):
+        return ("mark", self.code)
+
+    def layout_mark(self):
         """
-        Draws the station and its platforms.
+        Returns the Element that stands in for the station and all its
+        platforms when zoomed well out - a tick across them - or None if
+        it has no platforms to show.
         """
-        for platform in self.platforms.values():
-            if not platform.drawn:
-                platform.draw(ctx)
-        if not self.label_direction:
-            self.decide_label_direction()
-        self.draw_label(ctx)
+        platforms = [
+            platform for platform in self.platforms.values()
+            if platform.length and platform.line.code != "none"
+        ]
+        if platforms:
+            across = platforms[0].direction.right.right.vector
+            mid_points = sorted(
+                [platform.mid_point for platform in platforms],
+                key = lambda point: point.dot(across),
+            )
+            start = mid_points[0] - across * (self.mark_length / 2.0)
+            end = mid_points[-1] + across * (self.mark_length / 2.0)
+            return Element.from_strokes(self.mark_key, [Stroke(
+                Path([("move_to", start.x, start.y)], point_bounds([start.tuple()])),
+                end.tuple(),
+                None,
+                self.label_color,
+                self.mark_width,
+                False,
+            )])
 
     def draw_debug(self, ctx, highlighted):
         """
@@ -124,128 +250,190 @@ class Station(object):
         ctx.restore()
 
 
-    def draw_label(self, ctx):
+    def layout_label(self, ctx):
+        """
+        Returns the Element for this station's label, or None if it
+        doesn't have one. The context is only used to measure the text.
+
+        The label's position relative to the station is kept between
+        calls (for each direction), so moving the station only needs it
+        shifting along.
+        """
         if self.name:
-            # Work out the bounding box of the platforms
-            x_range = [0, 0]
-            y_range = [0, 0]
-            platform_directions = set()
-            label_dir = self.label_direction
-            for platform in self.platforms.values():
-                platform_directions.add(platform.direction)
-                # Diagonal platforms perpendicular to label direction
-                # get put closer
-                if platform.direction == label_dir.right.right or \
-                   platform.direction == label_dir.left.left:
-                    ends = [platform.mid_point]
-                    if platform.platform_side & Segment.PLATFORM_LEFT:
-                        ends.append(
-                            platform.mid_point +
-                            (platform.direction.left.left.vector * Segment.platform_distance)
-                        )
-                    if platform.platform_side & Segment.PLATFORM_RIGHT:
-                        ends.append(
-                            platform.mid_point +
-                            (platform.direction.right.right.vector * Segment.platform_distance)
-                        )
-                # Use bounding box
+            origin = self.offset
+            label_offset = self.label_offset
+            placed = []
+            glyph_runs = []
+            bounds = None
+            for relative, text, extents, glyphs in self.label_anchor(ctx, self.shown_label_direction):
+                position = relative + origin + label_offset
+                x_bearing, y_bearing, width, height = extents
+                placed.append((position.x, position.y, text))
+                if glyphs is None:
+                    glyph_runs.append(None)
                 else:
-                    ends = [platform.start_point, platform.end_point]
-                    if platform.platform_side & Segment.PLATFORM_LEFT:
-                        ends.append(
-                            platform.start_point +
-                            (platform.direction.left.left.vector * Segment.platform_distance)
-                        )
-                        ends.append(
-                            platform.end_point +
-                            (platform.direction.left.left.vector * Segment.platform_distance)
-                        )
-                    if platform.platform_side & Segment.PLATFORM_RIGHT:
-                        ends.append(
-                            platform.start_point +
-                            (platform.direction.right.right.vector * Segment.platform_distance)
-                        )
-                        ends.append(
-                            platform.end_point +
-                            (platform.direction.right.right.vector * Segment.platform_distance)
-                        )
-                for end in ends:
-                    end = end - self.offset
-                    x_range[0] = min(end.x, x_range[0])
-                    y_range[0] = min(end.y, y_range[0])
-                    x_range[1] = max(end.x, x_range[1])
-                    y_range[1] = max(end.y, y_range[1])
-            ctx.set_source_rgb(*self.label_color)
-            ctx.select_font_face(
-                "LondonTwo",
-                cairo.FONT_SLANT_NORMAL,
-                cairo.FONT_WEIGHT_NORMAL,
-            )
-            ctx.set_font_size(self.label_size)
-            lines = [{"text": x.strip()} for x in self.name.split("\\n")]
-            # Work out the size of the entire label
-            dir_vector = self.label_direction.vector
-            width = 0
-            height = 0
-            for line in lines:
-                x_bearing, y_bearing, this_width, this_height = \
-                    ctx.text_extents(line['text'])[:4]
-                width = max(width, this_width)
-                height += this_height
-                line['y'] = height
-                line['height'] = this_height
-                line['width'] = this_width
-                line['x_bearing'] = x_bearing
-                line['y_bearing'] = y_bearing
-                height += 1
-            height -= 1
-            # Work out where to place it, using the text midpoint as the origin
-            if dir_vector.x < 0:
-                x_offset = x_range[0] - width / 2.0
-                x_mult = 1
-            elif dir_vector.x == 0:
-                x_offset = 0
-                x_mult = 0.5
-            else:
-                x_offset = x_range[1] + width / 2.0
-                x_mult = 0
-            if dir_vector.y < 0:
-                y_offset = y_range[0] - height / 2.0
-                y_delta = -ctx.font_extents()[1] * 0.6
-            elif dir_vector.y == 0:
-                y_offset = 0
-                y_delta = 0
+                    glyph_runs.append(tuple([
+                        (index, x + position.x, y + position.y)
+                        for index, x, y in glyphs
+                    ]))
+                bounds = union_bounds(bounds, (
+                    position.x + x_bearing,
+                    position.y + y_bearing,
+                    position.x + x_bearing + width,
+                    position.y + y_bearing + height,
+                ))
+            return Element.from_label(self.label_key, Label(
+                tuple(placed),
+                tuple(glyph_runs),
+                self.label_font,
+                self.label_size,
+                self.label_color,
+                bounds,
+            ))
+
+    def measure_label(self, ctx):
+        """
+        Measures the label's text, so it can be laid out later without a
+        context (as it is by other processes; see parallel.py).
+        """
+        if self.name:
+            self.label_metrics.font_extents(ctx, self.label_font, self.label_size)
+            for text in self.name.split("\\n"):
+                self.label_metrics.text(ctx, self.label_font, self.label_size, text.strip())
+
+    def label_anchor(self, ctx, direction):
+        "Returns anchor_label(ctx, direction), remembering it."
+        if direction not in self._label_anchors:
+            self._label_anchors[direction] = self.anchor_label(ctx, direction)
+        return self._label_anchors[direction]
+
+    def label_bounds(self, ctx, direction):
+        """
+        Returns the (x1, y1, x2, y2) box the label would cover if it were
+        put in the given direction, or None if there's no label.
+        """
+        if self.name:
+            origin = self.offset
+            label_offset = self.label_offset
+            bounds = None
+            for relative, text, extents, glyphs in self.label_anchor(ctx, direction):
+                position = relative + origin + label_offset
+                x_bearing, y_bearing, width, height = extents
+                x = position.x + x_bearing
+                y = position.y + y_bearing
+                bounds = union_bounds(bounds, (x, y, x + width, y + height))
+            return bounds
+
+    def anchor_label(self, ctx, direction):
+        """
+        Works out where each line of the label goes relative to the
+        station if it's put in the given direction, returning a list of
+        (relative position, text, extents, glyphs) with glyphs shaped at
+        the origin (or None).
+        """
+        # Work out the bounding box of the platforms
+        x_range = [0, 0]
+        y_range = [0, 0]
+        platform_directions = set()
+        label_dir = direction
+        for platform in self.platforms.values():
+            platform_directions.add(platform.direction)
+            # Diagonal platforms perpendicular to label direction
+            # get put closer
+            if platform.direction == label_dir.right.right or \
+               platform.direction == label_dir.left.left:
+                ends = [platform.mid_point]
+                if platform.platform_side & Segment.PLATFORM_LEFT:
+                    ends.append(
+                        platform.mid_point +
+                        (platform.direction.left.left.vector * Segment.platform_distance)
+                    )
+                if platform.platform_side & Segment.PLATFORM_RIGHT:
+                    ends.append(
+                        platform.mid_point +
+                        (platform.direction.right.right.vector * Segment.platform_distance)
+                    )
+            # Use bounding box
             else:
-                y_offset = y_range[1] + height / 2.0
-                y_delta = 0
-            y_offset -= (self.label_size / 8.0)
-            # Draw!
-            for line in lines:
-                line_x = -line['x_bearing'] + (-width/2.0) - (line['width'] - width) * x_mult
-                line_y = y_delta + line['y'] - (height / 2.0)
-                position = (
-                    Vector(x_offset, y_offset) +
-                    Vector(line_x, line_y) +
-                    Vector(
-                        dir_vector.x * self.label_distance.x,
-                        dir_vector.y * self.label_distance.y,
-                    ) +
-                    self.offset +
-                    self.label_offset
+                ends = [platform.start_point, platform.end_point]
+                if platform.platform_side & Segment.PLATFORM_LEFT:
+                    ends.append(
+                        platform.start_point +
+                        (platform.direction.left.left.vector * Segment.platform_distance)
+                    )
+                    ends.append(
+                        platform.end_point +
+                        (platform.direction.left.left.vector * Segment.platform_distance)
+                    )
+                if platform.platform_side & Segment.PLATFORM_RIGHT:
+                    ends.append(
+                        platform.start_point +
+                        (platform.direction.right.right.vector * Segment.platform_distance)
+                    )
+                    ends.append(
+                        platform.end_point +
+                        (platform.direction.right.right.vector * Segment.platform_distance)
+                    )
+            for end in ends:
+                end = end - self.offset
+                x_range[0] = min(end.x, x_range[0])
+                y_range[0] = min(end.y, y_range[0])
+                x_range[1] = max(end.x, x_range[1])
+                y_range[1] = max(end.y, y_range[1])
+        lines = []
+        for text in self.name.split("\\n"):
+            text = text.strip()
+            extents, glyphs = self.label_metrics.text(ctx, self.label_font, self.label_size, text)
+            lines.append({"text": text, "extents": extents, "glyphs": glyphs})
+        # Work out the size of the entire label
+        dir_vector = direction.vector
+        width = 0
+        height = 0
+        for line in lines:
+            x_bearing, y_bearing, this_width, this_height = line['extents']
+            width = max(width, this_width)
+            height += this_height
+            line['y'] = height
+            line['height'] = this_height
+            line['width'] = this_width
+            line['x_bearing'] = x_bearing
+            line['y_bearing'] = y_bearing
+            height += 1
+        height -= 1
+        # Work out where to place it, using the text midpoint as the origin
+        if dir_vector.x < 0:
+            x_offset = x_range[0] - width / 2.0
+            x_mult = 1
+        elif dir_vector.x == 0:
+            x_offset = 0
+            x_mult = 0.5
+        else:
+            x_offset = x_range[1] + width / 2.0
+            x_mult = 0
+        if dir_vector.y < 0:
+            y_offset = y_range[0] - height / 2.0
+            y_delta = -self.label_metrics.font_extents(ctx, self.label_font, self.label_size)[1] * 0.6
+        elif dir_vector.y == 0:
+            y_offset = 0
+            y_delta = 0
+        else:
+            y_offset = y_range[1] + height / 2.0
+            y_delta = 0
+        y_offset -= (self.label_size / 8.0)
+        anchor = []
+        for line in lines:
+            line_x = -line['x_bearing'] + (-width/2.0) - (line['width'] - width) * x_mult
+            line_y = y_delta + line['y'] - (height / 2.0)
+            relative = (
+                Vector(x_offset, y_offset) +
+                Vector(line_x, line_y) +
+                Vector(
+                    dir_vector.x * self.label_distance.x,
+                    dir_vector.y * self.label_distance.y,
                 )
-                ctx.move_to(*position)
-                ctx.show_text(line['text'])
-            if False: # debug
-                ctx.fill()
-                ctx.set_source_rgb(0,1,1)
-                ctx.arc(self.offset.x + x_offset, self.offset.y + y_offset, 2, 0, 7)
-                ctx.fill()
-                ctx.set_source_rgb(0,0.5,1)
-                ctx.arc(self.offset.x + x_range[1], self.offset.y + y_range[1], 2, 0, 7)
-                ctx.fill()
-                ctx.set_source_rgb(1,0,1)
-                ctx.arc(self.offset.x + x_range[0], self.offset.y + y_range[0], 2, 0, 7)
-                ctx.fill()
+            )
+            anchor.append((relative, line['text'], line['extents'], line['glyphs']))
+        return anchor
 
 
 class Points(Station):
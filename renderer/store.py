@@ -0,0 +1,140 @@
+"""
+A packed copy of a map's station positions, one array per attribute.
+
+A Map keeps every station as a Python object, which is what layout and
+editing want, but makes working out positions a walk up relative_to
+chains through objects and properties. A MapStore holds just the geometry -
+offsets as written, parents and resolved positions - in flat columns, so
+moving a selection re-resolves just the stations it affects, in one pass,
+and the map's extents are kept up to date as stations move.
+"""
+
+from array import array
+
+
+class MapStore(object):
+    """
+    Station positions as packed columns. Stations are referred to by row
+    number (id), which ids maps them to; parents always come before the
+    stations placed relative to them.
+
+    The columns are offset_x and offset_y (the offset as written, relative
+    to the parent if there is one) and parent (-1 for none), plus the
+    absolute x and y worked out by resolve(). The numbers come out exactly
+    as Station.offset works them out.
+
+    The Station objects still hold their own offsets too; this is an
+    index over them, not a replacement.
+    """
+
+    def __init__(self, stations=()):
+        self.stations = []
+        self.ids = {}
+        self.offset_x = array("d")
+        self.offset_y = array("d")
+        self.parent = array("i")
+        # [min x, max x, min y, max y], or None to work out again
+        self._extents = None
+        for station in stations:
+            self.add(station)
+        self.resolve()
+
+    def add(self, station):
+        "Adds a station (and its parents first, if they're not in yet)."
+        if station in self.ids:
+            return
+        if station.relative_to:
+            self.add(station.relative_to)
+        self.ids[station] = len(self.stations)
+        self.stations.append(station)
+        self.offset_x.append(station._offset.x)
+        self.offset_y.append(station._offset.y)
+        self.parent.append(self.ids[station.relative_to] if station.relative_to else -1)
+
+    def resolve(self, stations=None):
+        """
+        Works out the absolute positions of the given stations, or all of
+        them. Parents come first, so this is one pass however deep the
+        chains go; anything placed relative to a given station has to be
+        given too.
+        """
+        if stations is None:
+            self.x = x = array("d", self.offset_x)
+            self.y = y = array("d", self.offset_y)
+            indexes = xrange(len(self.stations))
+        else:
+            x = self.x
+            y = self.y
+            indexes = sorted(self.ids[station] for station in stations)
+        offset_x = self.offset_x
+        offset_y = self.offset_y
+        parents = self.parent
+        for index in indexes:
+            parent = parents[index]
+            if parent >= 0:
+                x[index] = x[parent] + offset_x[index]
+                y[index] = y[parent] + offset_y[index]
+            else:
+                x[index] = offset_x[index]
+                y[index] = offset_y[index]
+
+    def position(self, station):
+        "Returns the station's absolute (x, y) position."
+        index = self.ids[station]
+        return (self.x[index], self.y[index])
+
+    def offset(self, station):
+        "Returns the station's (x, y) offset as written."
+        index = self.ids[station]
+        return (self.offset_x[index], self.offset_y[index])
+
+    def extents(self):
+        """
+        Returns [min x, max x, min y, max y] of the coordinates as written
+        (so relative stations count by their offset), always including the
+        origin. It's only worked out from all the columns again after a
+        station on the edge has moved.
+        """
+        if self._extents is None:
+            self._extents = [
+                min(min(self.offset_x or [0]), 0),
+                max(max(self.offset_x or [0]), 0),
+                min(min(self.offset_y or [0]), 0),
+                max(max(self.offset_y or [0]), 0),
+            ]
+        return list(self._extents)
+
+    def set_offset(self, index, x, y):
+        "Changes the offset of the station with the given id, keeping extents."
+        extents = self._extents
+        if extents is not None:
+            if self.offset_x[index] in extents[:2] or self.offset_y[index] in extents[2:]:
+                # It might have been the only thing out that far
+                self._extents = None
+            else:
+                extents[0] = min(extents[0], x)
+                extents[1] = max(extents[1], x)
+                extents[2] = min(extents[2], y)
+                extents[3] = max(extents[3], y)
+        self.offset_x[index] = x
+        self.offset_y[index] = y
+
+    def move(self, station, x, y, dependents):
+        """
+        Sets one station's offset, re-resolving it and its dependents
+        (everything placed relative to it, however indirectly, and itself).
+        """
+        self.set_offset(self.ids[station], x, y)
+        self.resolve(dependents)
+
+    def translate(self, stations, dx, dy, dependents):
+        """
+        Moves the given stations by (dx, dy), as dragging a selection does,
+        re-resolving just their dependents (everything placed relative to
+        them, however indirectly, and themselves).
+        """
+        offset_x = self.offset_x
+        offset_y = self.offset_y
+        for index in set(self.ids[station] for station in stations):
+            self.set_offset(index, offset_x[index] + dx, offset_y[index] + dy)
+        self.resolve(dependents)
@@ -0,0 +1,181 @@
+"""
+Checks OrderedMap keeps exactly the order the SortedDict it replaced did.
+
+Run from this directory with ``python -m unittest test_datastructures``.
+"""
+
+import random
+import unittest
+from types import GeneratorType
+
+from datastructures import OrderedMap
+
+
+class SortedDict(dict):
+    """
+    The SortedDict Map used before OrderedMap, as it was, to check against.
+    """
+    def __new__(cls, *args, **kwargs):
+        instance = super(SortedDict, cls).__new__(cls, *args, **kwargs)
+        instance.keyOrder = []
+        return instance
+
+    def __init__(self, data=None):
+        if data is None:
+            data = {}
+        elif isinstance(data, GeneratorType):
+            data = list(data)
+        super(SortedDict, self).__init__(data)
+        if isinstance(data, dict):
+            self.keyOrder = data.keys()
+        else:
+            self.keyOrder = []
+            seen = set()
+            for key, value in data:
+                if key not in seen:
+                    self.keyOrder.append(key)
+                    seen.add(key)
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self.keyOrder.append(key)
+        super(SortedDict, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(SortedDict, self).__delitem__(key)
+        self.keyOrder.remove(key)
+
+    def __iter__(self):
+        return iter(self.keyOrder)
+
+    def pop(self, k, *args):
+        result = super(SortedDict, self).pop(k, *args)
+        try:
+            self.keyOrder.remove(k)
+        except ValueError:
+            pass
+        return result
+
+    def items(self):
+        return zip(self.keyOrder, self.values())
+
+    def keys(self):
+        return self.keyOrder[:]
+
+    def values(self):
+        return map(self.__getitem__, self.keyOrder)
+
+    def setdefault(self, key, default):
+        if key not in self:
+            self.keyOrder.append(key)
+        return super(SortedDict, self).setdefault(key, default)
+
+    def value_for_index(self, index):
+        return self[self.keyOrder[index]]
+
+    def insert(self, index, key, value):
+        if key in self.keyOrder:
+            n = self.keyOrder.index(key)
+            del self.keyOrder[n]
+            if n < index:
+                index -= 1
+        self.keyOrder.insert(index, key)
+        super(SortedDict, self).__setitem__(key, value)
+
+    def copy(self):
+        obj = self.__class__(self)
+        obj.keyOrder = self.keyOrder[:]
+        return obj
+
+
+class OrderedMapTests(unittest.TestCase):
+
+    steps = 3000
+
+    def assertSameOrder(self, new, old, step):
+        self.assertEqual(list(new.keys()), old.keys(), "keys differ after %r" % (step, ))
+        self.assertEqual(list(new.values()), old.values(), "values differ after %r" % (step, ))
+        self.assertEqual(list(new), list(old))
+        self.assertEqual(new.items(), old.items())
+        self.assertEqual(len(new), len(old))
+
+    def step(self, rng, new, old):
+        "Does one random operation to both, returning what it was."
+        key = rng.randrange(40)
+        value = rng.random()
+        operation = rng.choice([
+            "set", "set", "delete", "pop", "pop missing", "setdefault",
+            "insert", "first", "last", "copy", "value for index",
+        ])
+        if operation == "set":
+            new[key] = old[key] = value
+        elif operation == "delete":
+            if key in old:
+                del new[key]
+                del old[key]
+        elif operation == "pop":
+            self.assertEqual(new.pop(key, None), old.pop(key, None))
+        elif operation == "pop missing":
+            self.assertEqual(new.pop(-1, "gone"), old.pop(-1, "gone"))
+        elif operation == "setdefault":
+            self.assertEqual(new.setdefault(key, value), old.setdefault(key, value))
+        elif operation == "insert":
+            index = rng.randint(-len(old) - 2, len(old) + 2)
+            new.insert(index, key, value)
+            old.insert(index, key, value)
+        elif operation in ("first", "last"):
+            # How Map.build() puts the draw first and last stations at the
+            # ends: it used to insert() them there, and now moves them
+            if key in old:
+                if operation == "first":
+                    new.move_to_end(key, last=False)
+                    old.insert(0, key, old[key])
+                else:
+                    new.move_to_end(key)
+                    old.insert(len(old), key, old[key])
+        elif operation == "copy":
+            new = new.copy()
+            old = old.copy()
+        elif operation == "value for index":
+            if old:
+                index = rng.randrange(len(old))
+                self.assertEqual(new.value_for_index(index), old.value_for_index(index))
+        return new, old, (operation, key)
+
+    def test_same_order_as_sorted_dict(self):
+        for seed in range(5):
+            rng = random.Random(seed)
+            new = OrderedMap()
+            old = SortedDict()
+            for i in range(self.steps):
+                new, old, step = self.step(rng, new, old)
+                self.assertSameOrder(new, old, step)
+
+    def test_construction(self):
+        pairs = [(3, "a"), (1, "b"), (2, "c"), (1, "d")]
+        self.assertSameOrder(OrderedMap(pairs), SortedDict(pairs), "construction")
+
+    def test_keys_and_values_are_snapshots(self):
+        """
+        keys() and values() are tuples rather than lists, so they can't be
+        changed in place; they're also not affected by later changes to the
+        map. Callers wanting a list to change must copy them with list().
+        """
+        map = OrderedMap([("a", 1), ("b", 2)])
+        keys = map.keys()
+        values = map.values()
+        self.assertTrue(isinstance(keys, tuple))
+        self.assertTrue(isinstance(values, tuple))
+        self.assertRaises(AttributeError, getattr, keys, "append")
+        # The same tuple comes back until something changes
+        self.assertTrue(map.keys() is keys)
+        map["c"] = 3
+        map.move_to_end("a")
+        self.assertEqual(keys, ("a", "b"))
+        self.assertEqual(values, (1, 2))
+        self.assertEqual(map.keys(), ("b", "c", "a"))
+        self.assertEqual(map.values(), (2, 3, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Checks automatic label placement, with text measured to fixed sizes so the
+results don't depend on which fonts are installed.
+
+Run from this directory with ``python -m unittest test_labels``.
+"""
+
+import os
+import unittest
+
+from draw import Direction, Segment
+from geometry import measuring_context
+from labels import overlap_area
+from main import Map
+from station import Station, TextMetrics
+
+
+SYSTEMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "systems")
+
+
+class FixedMetrics(TextMetrics):
+    "Measures every character of every font as the same size box."
+
+    def font_extents(self, ctx, face, size):
+        return (size * 0.8, size * 0.2, size, size * 0.6, 0)
+
+    def text(self, ctx, face, size, text):
+        return (0, -size * 0.8, len(text) * size * 0.6, size), None
+
+
+def loaded(name):
+    map = Map()
+    map.load(os.path.join(SYSTEMS, name, name + ".txt"), use_cache=False)
+    return map
+
+
+def label_boxes(map, ctx, direction=None):
+    """
+    Returns the label box of each named station, by code, in its shown
+    direction - or in the given one, for those without a label line.
+    """
+    boxes = {}
+    for station in map.stations.values():
+        if station.name:
+            shown = station.label_direction or direction or station.shown_label_direction
+            boxes[station.code] = station.label_bounds(ctx, shown)
+    return boxes
+
+
+def overlapping(boxes):
+    "Returns the set of pairs of codes whose boxes overlap."
+    codes = sorted(boxes)
+    return set(
+        (a, b)
+        for i, a in enumerate(codes)
+        for b in codes[i + 1:]
+        if overlap_area(boxes[a], boxes[b])
+    )
+
+
+class LabelPlacementTests(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Station.label_metrics
+        Station.label_metrics = FixedMetrics()
+        self.ctx = measuring_context()
+
+    def tearDown(self):
+        Station.label_metrics = self.metrics
+
+    def build(self, stations):
+        """
+        Returns a map of the given (code, name, x, y, label direction)
+        stations, each with a single north-south platform.
+        """
+        records = [(0, "line", "red", [(1, 0, 0)])]
+        for code, name, x, y, label in stations:
+            records.append((0, "station", code, name, x, y, None))
+            records.append((0, "platform", code, "1", Direction.N.direction, "red", Segment.PLATFORM_BOTH))
+            if label is not None:
+                records.append((0, "label", label.direction))
+        map = Map()
+        map.build(records)
+        return map
+
+    def assertNoNewOverlaps(self, name):
+        """
+        Placing labels shouldn't make any label overlap another that didn't
+        already with every unlabelled station's label to the W.
+        """
+        map = loaded(name)
+        before = overlapping(label_boxes(map, self.ctx, Direction.W))
+        map.place_labels(self.ctx)
+        after = overlapping(label_boxes(map, self.ctx))
+        self.assertEqual(after - before, set())
+
+    def test_london(self):
+        self.assertNoNewOverlaps("london")
+
+    def test_san_francisco(self):
+        self.assertNoNewOverlaps("san-francisco")
+
+    def test_west_kept_when_free(self):
+        map = self.build([
+            ("AAA", "Alpha", 0, 0, None),
+            ("BBB", "Bravo", 0, 200, None),
+        ])
+        map.place_labels(self.ctx)
+        for station in map.stations.values():
+            self.assertIs(station.shown_label_direction, Direction.W)
+
+    def test_moves_off_covered_west(self):
+        # Bravo's label line puts its label right where Alpha's W one goes
+        map = self.build([
+            ("AAA", "Alpha", 0, 0, None),
+            ("BBB", "Bravo", -40, 0, Direction.E),
+        ])
+        map.place_labels(self.ctx)
+        alpha, bravo = map.stations["AAA"], map.stations["BBB"]
+        self.assertTrue(overlap_area(
+            alpha.label_bounds(self.ctx, Direction.W),
+            bravo.label_bounds(self.ctx, Direction.E),
+        ))
+        self.assertIsNot(alpha.shown_label_direction, Direction.W)
+        self.assertEqual(overlapping(label_boxes(map, self.ctx)), set())
+
+    def test_bounded_layout_does_not_place(self):
+        map = loaded("london")
+        x1, x2, y1, y2 = map.extents
+        map.layout(self.ctx, (x1, y1, x1 + 100, y1 + 100))
+        self.assertFalse(map.label_placer.started)
+        # Only the track that might reach the corner was routed
+        self.assertTrue(len([key for key in map.laid_out if key[0] == "outbound"]) < len(map.outbounds))
+        map.layout(self.ctx)
+        self.assertTrue(map.label_placer.started)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+"""
+Checks Segment.solve() against the step-by-step router it replaced.
+
+Run from this directory with ``python -m unittest test_routing``.
+"""
+
+import os
+import random
+import unittest
+
+from draw import Direction, Segment
+from main import Map
+from vector import Vector
+
+
+SYSTEMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "systems")
+
+
+def old_solve(self):
+    """
+    The routing loop Segment used before solve() was planned up front, as
+    it was, to check against. It gives up (without getting to the end
+    point) once the path is over ten corners long.
+    """
+    point = self.start_point
+    dir = self.start_dir
+    path = [(self.start_point, None)]
+    while point != self.end_point:
+        toend = self.end_point - point
+        if round(toend.projonto(dir.vector), 1) == round(abs(toend), 1):
+            path.append((self.end_point, dir))
+            break
+        left_proj = toend.projonto(dir.left.vector)
+        right_proj = toend.projonto(dir.right.vector)
+        if left_proj > right_proj:
+            bend = lambda x: x.left
+            proj_value = left_proj
+        else:
+            bend = lambda x: x.right
+            proj_value = right_proj
+        # Single bend
+        if self.end_dir == bend(dir) and proj_value > 0:
+            first_vector = dir.vector
+            second_vector = bend(dir).vector
+            p = Vector(second_vector.y, -second_vector.x)
+            h = ((self.end_point - point).dot(p)) / first_vector.dot(p)
+            if h > 0:
+                intersects = point + (first_vector * h)
+                path.append((intersects, dir))
+                path.append((self.end_point, bend(dir)))
+                break
+            else:
+                path.append(((point + dir.vector * self.min_length), dir))
+                point = path[-1][0]
+                dir = bend(dir)
+        # Double bend
+        elif self.end_dir == bend(bend(dir)) and proj_value > 0:
+            first_vector = dir.vector
+            second_vector = bend(bend(dir)).vector
+            p = Vector(second_vector.y, -second_vector.x)
+            h = ((self.end_point - point).dot(p)) / first_vector.dot(p)
+            if h > 0:
+                intersects = point + (first_vector * h)
+                offset = min(
+                    abs((self.end_point - intersects).projonto(second_vector)),
+                    abs((self.start_point - intersects).projonto(first_vector)),
+                )
+                path.append((intersects - (first_vector * (offset - self.min_length)), dir))
+                point = path[-1][0]
+                dir = bend(dir)
+            else:
+                path.append(((point + dir.vector * self.min_length), dir))
+                point = path[-1][0]
+                dir = bend(dir)
+        # Dogleg
+        elif self.end_dir == dir and proj_value > 0:
+            mid = (self.start_point + self.end_point) / 2.0
+            first_vector = dir.vector
+            second_vector = bend(dir).vector
+            p = Vector(second_vector.y, -second_vector.x)
+            h = ((mid - point).dot(p)) / first_vector.dot(p)
+            intersects = point + (first_vector * h)
+            path.append((intersects, dir))
+            point = path[-1][0]
+            dir = bend(dir)
+        # Too much already?
+        elif len(path) > 10:
+            break
+        else:
+            path.append(((point + dir.vector * self.min_length), dir))
+            point = path[-1][0]
+            dir = bend(dir)
+    return path
+
+
+def on_grid(path, segment):
+    """
+    Returns True if every leg of the path runs forwards along its
+    direction, and it arrives at the end point in the end direction.
+    """
+    for (start, _), (end, dir) in zip(path, path[1:]):
+        leg = end - start
+        if abs(leg.x * dir.vector.y - leg.y * dir.vector.x) > 1e-6 or leg.dot(dir.vector) < -1e-9:
+            return False
+    return path[-1][0] == segment.end_point and path[-1][1] == segment.end_dir
+
+
+class RoutingTests(unittest.TestCase):
+
+    cases = 20000
+
+    def assertMatchesOld(self, segment):
+        path, solved = segment.solve()
+        old_path = old_solve(segment)
+        description = (segment.start_dir, segment.end_dir, segment.end_point - segment.start_point, segment.min_length)
+        if solved:
+            # Anything solved comes out exactly as it used to
+            self.assertEqual(path, old_path, "%r routes differently" % (description, ))
+        else:
+            # Anything the old router gave up on is reported, and the only
+            # routes on the grid given up on now are ones it only found by
+            # circling back round past the end point
+            self.assertFalse(
+                on_grid(old_path, segment) and len(old_path) < 10,
+                "%r is no longer solved" % (description, ),
+            )
+        if old_path[-1][0] != segment.end_point:
+            self.assertFalse(solved, "%r is marked solved" % (description, ))
+        return solved
+
+    def assertSystemMatches(self, name):
+        map = Map()
+        map.load(os.path.join(SYSTEMS, name, name + ".txt"), use_cache=False)
+        for index in range(len(map.outbounds)):
+            segment = map.outbound_segment(index)
+            self.assertTrue(self.assertMatchesOld(segment), map.describe_outbound(index))
+            self.assertEqual(segment.solve()[0], old_solve(segment))
+
+    def test_london(self):
+        self.assertSystemMatches("london")
+
+    def test_san_francisco(self):
+        self.assertSystemMatches("san-francisco")
+
+    def test_random(self):
+        rng = random.Random(0)
+        solved = 0
+        for i in range(self.cases):
+            if rng.random() < 0.5:
+                end = Vector(rng.randint(-30, 30) * 5, rng.randint(-30, 30) * 5)
+            else:
+                end = Vector(rng.uniform(-150, 150), rng.uniform(-150, 150))
+            if end == Vector(0, 0):
+                continue
+            segment = Segment(Vector(0, 0), Direction(rng.randrange(8)), end, Direction(rng.randrange(8)))
+            segment.min_length = rng.choice([5, 10, 20, 35])
+            solved += self.assertMatchesOld(segment)
+        # Make sure plenty of both kinds came up
+        self.assertTrue(self.cases // 4 < solved < self.cases * 3 // 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Checks that saving moved stations survives a failed write.
+
+Run from this directory with ``python -m unittest test_saving``.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from main import Map
+from vector import Vector
+
+
+SYSTEMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "systems")
+
+
+class SaveOffsetsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "london.txt")
+        shutil.copy(os.path.join(SYSTEMS, "london", "london.txt"), self.filename)
+        self.map = Map()
+        self.map.load(self.filename, use_cache=False)
+        self.map.move_station(self.map.stations["WAL"], Vector(900, -800))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def saved(self):
+        "Returns the map as it now loads from the file."
+        map = Map()
+        map.load(self.filename, use_cache=False)
+        return map
+
+    def hide_file(self):
+        "Moves the file out of the way, returning a function to put it back."
+        os.rename(self.filename, self.filename + ".hidden")
+        return lambda: os.rename(self.filename + ".hidden", self.filename)
+
+    def test_saves_after_failure(self):
+        put_back = self.hide_file()
+        self.assertRaises(IOError, self.map.save_offsets, self.filename)
+        put_back()
+        self.map.save_offsets(self.filename)
+        self.assertEqual(self.saved().stations["WAL"]._offset, Vector(900, -800))
+        # And there's nothing left to save
+        self.assertEqual(self.map.save_offsets(self.filename), None)
+
+    def test_background_failure_reported(self):
+        errors = []
+        put_back = self.hide_file()
+        self.map.save_offsets(self.filename, background=True, on_error=errors.append).join()
+        put_back()
+        self.assertEqual([type(error) for error in errors], [IOError])
+        self.map.save_offsets(self.filename, background=True, on_error=errors.append).join()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.saved().stations["WAL"]._offset, Vector(900, -800))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+Checks the packed station store against the Station objects it mirrors.
+
+Run from this directory with ``python -m unittest test_store``.
+"""
+
+import os
+import unittest
+
+from main import Map
+from vector import Vector
+
+
+SYSTEMS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "systems")
+
+
+def loaded(name):
+    map = Map()
+    map.load(os.path.join(SYSTEMS, name, name + ".txt"), use_cache=False)
+    return map
+
+
+class MapStoreTests(unittest.TestCase):
+
+    def assertMatchesStations(self, map):
+        for station in map.stations.values():
+            self.assertEqual(map.store.position(station), station.offset.tuple())
+            self.assertEqual(map.store.offset(station), station._offset.tuple())
+            self.assertEqual(map.station_index.positions[station], station.offset.tuple())
+
+    def test_positions(self):
+        for name in ("london", "san-francisco"):
+            self.assertMatchesStations(loaded(name))
+
+    def assertExtentsRight(self, map):
+        coords = [station._offset for station in map.stations.values()]
+        self.assertEqual(map.extents, [
+            min([coord.x for coord in coords] + [0]),
+            max([coord.x for coord in coords] + [0]),
+            min([coord.y for coord in coords] + [0]),
+            max([coord.y for coord in coords] + [0]),
+        ])
+
+    def test_extents(self):
+        map = loaded("london")
+        self.assertExtentsRight(map)
+        # Out past the edge, then back in from it
+        west = min(map.stations.values(), key=lambda station: station._offset.x)
+        map.move_station(west, west._offset + Vector(-100, 0))
+        self.assertExtentsRight(map)
+        map.translate_stations([west], Vector(300, 0))
+        self.assertExtentsRight(map)
+
+    def test_stations_inside_bounds(self):
+        map = loaded("london")
+        tl, br = Vector(0, -500), Vector(600, 0)
+        expected = [
+            station for station in map.stations.values()
+            if not station.relative_to
+            and tl.x <= station.offset.x <= br.x
+            and tl.y <= station.offset.y <= br.y
+        ]
+        self.assertTrue(expected)
+        self.assertEqual(
+            set(map.stations_inside_bounds(tl, br)),
+            set(expected),
+        )
+
+    def test_translate_matches_move_station(self):
+        moved = loaded("london")
+        translated = loaded("london")
+        # Some with stations placed relative to them, and one without
+        codes = [
+            station.code for station in moved.stations.values()
+            if station.relative_children
+        ][:3]
+        codes += [
+            station.code for station in moved.stations.values()
+            if not station.relative_children
+        ][:1]
+        for code in codes:
+            station = moved.stations[code]
+            moved.move_station(station, station._offset + Vector(25, -10))
+        translated.translate_stations([translated.stations[code] for code in codes], Vector(25, -10))
+        self.assertMatchesStations(translated)
+        for code, station in moved.stations.items():
+            self.assertEqual(translated.stations[code].offset, station.offset)
+        self.assertEqual(
+            set(station.code for station in translated.moved),
+            set(codes),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,210 @@
+"""
+Exports a map as a z/x/y.png slippy-map tile pyramid, rendering tiles in
+parallel and skipping any whose contents haven't changed since last time.
+"""
+
+import cairo
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import argparse
+from main import Map
+from geometry import draw_batched, measuring_context
+from spatial import BoxIndex
+
+
+# Bump this if tiles would come out differently from the same geometry.
+TILE_VERSION = "1"
+
+
+class TilePyramid(object):
+    """
+    The grid of tiles covering a map. Zoom level 0 is a single tile
+    covering a square world area, and each level doubles the tiles along
+    each side.
+
+    The world square is snapped to a grid of tile_size units and rounded
+    up to a power of two, so small edits don't shift every tile.
+    """
+
+    tile_size = 256
+
+    def __init__(self, bounds, min_zoom=0, max_zoom=None):
+        x1, y1, x2, y2 = bounds
+        self.origin_x = math.floor(x1 / self.tile_size) * self.tile_size
+        self.origin_y = math.floor(y1 / self.tile_size) * self.tile_size
+        extent = max(x2 - self.origin_x, y2 - self.origin_y, 1)
+        self.side = self.tile_size * 2 ** int(math.ceil(math.log(extent / float(self.tile_size), 2)))
+        self.min_zoom = min_zoom
+        if max_zoom is None:
+            # Go down until tiles show the map at 4x its natural size
+            max_zoom = int(math.log(self.side / float(self.tile_size), 2)) + 2
+        self.max_zoom = max_zoom
+
+    def tiles(self):
+        "Yields (z, x, y) for every tile in the pyramid."
+        for z in range(self.min_zoom, self.max_zoom + 1):
+            for x in range(2 ** z):
+                for y in range(2 ** z):
+                    yield (z, x, y)
+
+    def tile_bounds(self, z, x, y):
+        "Returns the (x1, y1, x2, y2) world area a tile covers."
+        size = self.side / float(2 ** z)
+        return (
+            self.origin_x + x * size,
+            self.origin_y + y * size,
+            self.origin_x + (x + 1) * size,
+            self.origin_y + (y + 1) * size,
+        )
+
+    def transform(self, ctx, z, x, y):
+        "Sets the context up so map coordinates land on the given tile."
+        x1, y1, x2, y2 = self.tile_bounds(z, x, y)
+        scale = self.tile_size / (x2 - x1)
+        ctx.scale(scale, scale)
+        ctx.translate(-x1, -y1)
+
+
+class TileSet(object):
+    """
+    A laid-out map plus a spatial index of its elements, so the elements
+    on any one tile can be found (in drawing order) without a full scan.
+    """
+
+    def __init__(self, filename, min_zoom=0, max_zoom=None):
+        self.map = Map()
+        self.map.load(filename)
+        self.geometry = self.map.layout(measuring_context())
+        self.pyramid = TilePyramid(self.geometry.bounds, min_zoom, max_zoom)
+        self.index = BoxIndex(self.pyramid.side / 64.0)
+        for position, element in enumerate(self.geometry.elements):
+            self.index.insert(position, element.bounds)
+        self.digests = {}
+
+    def positions_for(self, tile):
+        """
+        Returns the positions (in the geometry) of the elements on the
+        given (z, x, y) tile, in drawing order.
+        """
+        # Allow a pixel for antialiasing spilling over the tile edge
+        x1, y1, x2, y2 = self.pyramid.tile_bounds(*tile)
+        pad = (x2 - x1) / self.pyramid.tile_size
+        return sorted(self.index.intersecting((x1 - pad, y1 - pad, x2 + pad, y2 + pad)))
+
+    def tile_digest(self, tile):
+        "Returns a hash of everything that goes into drawing the given tile."
+        digest = hashlib.sha1("%s %s %r %r" % (
+            TILE_VERSION,
+            self.pyramid.tile_size,
+            self.pyramid.tile_bounds(*tile),
+            tile,
+        ))
+        for position in self.positions_for(tile):
+            if position not in self.digests:
+                self.digests[position] = self.geometry.elements[position].digest()
+            digest.update(self.digests[position])
+        return digest.hexdigest()
+
+    def render(self, tile, filename):
+        "Renders the given (z, x, y) tile to a PNG file."
+        size = self.pyramid.tile_size
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+        ctx = cairo.Context(surface)
+        ctx.set_source_rgb(1, 1, 1)
+        ctx.paint()
+        self.pyramid.transform(ctx, *tile)
+        draw_batched(ctx, [
+            self.geometry.elements[position]
+            for position in self.positions_for(tile)
+        ])
+        surface.write_to_png(filename)
+
+
+# Each worker process loads and lays out the map once, into here.
+worker_tiles = None
+
+
+def init_worker(filename, min_zoom, max_zoom):
+    global worker_tiles
+    worker_tiles = TileSet(filename, min_zoom, max_zoom)
+
+
+def render_worker(job):
+    tile, filename = job
+    worker_tiles.render(tile, filename)
+    return tile
+
+
+def tile_filename(out_dir, tile):
+    return os.path.join(out_dir, "%s" % tile[0], "%s" % tile[1], "%s.png" % tile[2])
+
+
+def export_tiles(filename, out_dir, min_zoom=0, max_zoom=None, processes=None, force=False):
+    """
+    Renders the tile pyramid for a map file into out_dir, using a pool of
+    processes. A manifest of tile hashes is kept in out_dir, and tiles
+    whose hash hasn't changed (and still exist) are skipped.
+    Returns (rendered, skipped) tile counts.
+    """
+    tile_set = TileSet(filename, min_zoom, max_zoom)
+    manifest_path = os.path.join(out_dir, "tiles.json")
+    try:
+        with open(manifest_path) as fh:
+            old_digests = json.load(fh)
+    except (IOError, ValueError):
+        old_digests = {}
+    # Work out which tiles need doing
+    digests = {}
+    jobs = []
+    for tile in tile_set.pyramid.tiles():
+        name = "%s/%s/%s" % tile
+        digests[name] = tile_set.tile_digest(tile)
+        path = tile_filename(out_dir, tile)
+        if force or old_digests.get(name) != digests[name] or not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            jobs.append((tile, path))
+    # Render them
+    if jobs:
+        pool = multiprocessing.Pool(
+            processes,
+            initializer = init_worker,
+            initargs = (filename, min_zoom, tile_set.pyramid.max_zoom),
+        )
+        try:
+            for tile in pool.imap_unordered(render_worker, jobs, chunksize=16):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    # Save the manifest for next time
+    with open(manifest_path + ".new", "w") as fh:
+        json.dump(digests, fh, indent=1, sort_keys=True)
+    os.rename(manifest_path + ".new", manifest_path)
+    return len(jobs), len(digests) - len(jobs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate slippy-map tiles for a Twin Tubes map")
+    parser.add_argument('in_file', help='The source file for the map')
+    parser.add_argument('-o', '--out-dir', help='The directory to write tiles into')
+    parser.add_argument('--min-zoom', type=int, default=0, help='The first zoom level to render')
+    parser.add_argument('--max-zoom', type=int, default=None, help='The last zoom level to render')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='How many processes to render with')
+    parser.add_argument('-f', '--force', action='store_true', help='Render all tiles, changed or not')
+    args = parser.parse_args()
+    if args.out_dir == None:
+        args.out_dir = os.path.splitext(args.in_file)[0] + '-tiles'
+
+    rendered, skipped = export_tiles(
+        args.in_file,
+        args.out_dir,
+        min_zoom = args.min_zoom,
+        max_zoom = args.max_zoom,
+        processes = args.processes,
+        force = args.force,
+    )
+    print "Rendered %i tiles, %i unchanged" % (rendered, skipped)
@@ -2,57 +2,77 @@ import math
 
 
 class Vector(object):
-    
+
     """
-    A 2D vector class.
+    An immutable 2D vector class.
     """
-    
-    def __init__(self, x, y=None):
+
+    __slots__ = ("x", "y")
+
+    def __new__(cls, x, y=None):
+        self = _new(cls)
         if y == None:
             if isinstance(x, Vector):
-                self.x, self.y = x.x, x.y
+                _set_x(self, x.x)
+                _set_y(self, x.y)
             elif len(x) == 2:
-                self.x, self.y = x
+                _set_x(self, x[0])
+                _set_y(self, x[1])
             else:
                 raise ValueError("Please pass either a tuple of (x, y), a Vector, or two parameters.")
         else:
-            self.x = x
-            self.y = y
-    
+            _set_x(self, x)
+            _set_y(self, y)
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Vectors are immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Vectors are immutable")
+
+    def __reduce__(self):
+        return (_make, (self.x, self.y))
+
     def __add__(self, other):
-        return Vector(self.x + other.x, self.y + other.y)
-    
+        return _make(self.x + other.x, self.y + other.y)
+
     def __sub__(self, other):
-        return Vector(self.x - other.x, self.y - other.y)
-    
+        return _make(self.x - other.x, self.y - other.y)
+
     def __mul__(self, num):
-        return Vector(self.x * num, self.y * num)
-    
+        return _make(self.x * num, self.y * num)
+
     def __div__(self, num):
         return self * (1.0 / num)
-    
+
+    __truediv__ = __div__
+
     def __len__(self):
         return 2
-    
+
     def __abs__(self):
         "Cartesian distance of this vector"
         return (self.x ** 2 + self.y ** 2) ** 0.5
-    
+
     def __hash__(self):
         return hash((self.x, self.y))
-    
+
     def __eq__(self, other):
         if not isinstance(other, Vector):
             return False
         return (self.x == other.x) and (self.y == other.y)
-    
+
+    def __ne__(self, other):
+        return not self == other
+
     def __iter__(self):
         return iter(self.tuple())
 
     def tuple(self):
         "Returns the x and y parts of the vector raw."
         return self.x, self.y
-    
+
     def __repr__(self):
         return "<%s,%s>" % (self.x, self.y)
 
@@ -64,10 +84,24 @@ class Vector(object):
 
     def normalize(self):
         return self / abs(self)
-    
+
     def floor(self):
         "Returns this vector with components floored to the nearest integer"
-        return Vector(int(math.floor(self.x)), int(math.floor(self.y)))
+        return _make(int(math.floor(self.x)), int(math.floor(self.y)))
 
     def flip(self):
         return self * -1
+
+
+# Vectors are built a lot, so skip the argument juggling in __new__ (and the
+# immutability guard in __setattr__) for the internal arithmetic.
+_new = object.__new__
+_set_x = Vector.x.__set__
+_set_y = Vector.y.__set__
+
+
+def _make(x, y):
+    self = _new(Vector)
+    _set_x(self, x)
+    _set_y(self, y)
+    return self